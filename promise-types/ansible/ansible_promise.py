@@ -1,9 +1,173 @@
+import hashlib
+import json
 import os
+import socket
+import socketserver
+import subprocess
 import sys
+import time
 
 from typing import Dict, Tuple, List
 from cfengine_module_library import PromiseModule, ValidationError, Result
 
+STATE_FILE = "/var/cfengine/state/ansible_promise_state.json"
+WORKER_SOCKET = "/var/cfengine/state/ansible_promise_worker.sock"
+# Seconds without any agent run after which the worker exits
+WORKER_IDLE_TIMEOUT = 3600
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _module_signature():
+    signature = _file_signature(os.path.abspath(__file__))
+    return list(signature) if signature else None
+
+
+class BaseAnsiblePromiseTypeModule(PromiseModule):
+    def __init__(self, **kwargs):
+        super(BaseAnsiblePromiseTypeModule, self).__init__(
+            "ansible_promise_module", "0.0.0", **kwargs
+        )
+
+        def must_be_absolute(v):
+            if not os.path.isabs(v):
+                raise ValidationError("Must be an absolute path, not '{v}'".format(v=v))
+
+        def must_be_positive(v):
+            if v <= 0:
+                raise ValidationError(
+                    "Must be a positive number, not '{v}'".format(v=v)
+                )
+
+        self.add_attribute(
+            "playbook", str, default_to_promiser=True, validator=must_be_absolute
+        )
+        self.add_attribute("inventory", str, validator=must_be_absolute)
+        self.add_attribute("limit", list, default=[])
+        self.add_attribute("tags", list, default=[])
+        self.add_attribute("become", bool, default=False)
+        self.add_attribute("become_method", str, default="sudo")
+        self.add_attribute("become_user", str, default="root")
+        self.add_attribute("connection", str, default="local")
+        self.add_attribute("forks", int, default=1)
+        self.add_attribute("private_key_file", str, validator=must_be_absolute)
+        self.add_attribute("remote_user", str, default="root")
+        self.add_attribute("skip_unchanged", bool, default=False)
+        self.add_attribute(
+            "skip_max_age", int, default=3600, validator=must_be_positive
+        )
+        self.add_attribute("worker", bool, default=False)
+        self.add_attribute("slowest_tasks", int, default=10, validator=must_be_positive)
+        self.add_attribute("timing_profile", str, validator=must_be_absolute)
+
+        # Whether a promise asked for the playbooks to be run by the worker
+        self._worker_requested = False
+
+    def prepare_promiser_and_attributes(self, promiser, attributes):
+        safe_promiser = promiser.replace(",", "_")
+        return (safe_promiser, attributes)
+
+    def validate_promise(self, promiser: str, attributes: Dict, metadata: Dict):
+        return
+
+
+def _connect_to_worker():
+    """Connect to a running worker started from this very version of the
+    module, returning None if there is none."""
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        sock.connect(WORKER_SOCKET)
+    except OSError:
+        return None
+    connection = sock.makefile("rw")
+    try:
+        connection.write(
+            json.dumps({"operation": "hello", "module": _module_signature()}) + "\n"
+        )
+        connection.flush()
+        response = json.loads(connection.readline())
+    except (OSError, ValueError):
+        connection.close()
+        sock.close()
+        return None
+    if response.get("result") != Result.SUCCESS:
+        connection.close()
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return connection
+
+
+class AnsibleWorkerClientModule(BaseAnsiblePromiseTypeModule):
+    """Promise module passing the promises to the worker process, which
+    keeps the Ansible runtime, inventories and parsed playbooks loaded
+    between agent runs. It doesn't import Ansible at all."""
+
+    def __init__(self, connection, **kwargs):
+        super(AnsibleWorkerClientModule, self).__init__(**kwargs)
+        self._connection = connection
+
+    def evaluate_promise(
+        self, promiser: str, attributes: Dict, metadata: Dict
+    ) -> Tuple[str, List[str]]:
+        if attributes.get("worker"):
+            self._worker_requested = True
+
+        request = {
+            "operation": "evaluate",
+            "promiser": promiser,
+            "attributes": attributes,
+            "log_level": self._log_level,
+        }
+        try:
+            self._connection.write(json.dumps(request) + "\n")
+            self._connection.flush()
+            for line in self._connection:
+                if line.startswith("log_"):
+                    level, _, message = line[len("log_") :].rstrip("\n").partition("=")
+                    self._log(level, message)
+                    continue
+                response = json.loads(line)
+                return (response["result"], response["result_classes"])
+        except (OSError, ValueError, KeyError) as e:
+            self.log_error(
+                "Failed to run the playbook in the Ansible worker: {error}".format(
+                    error=e
+                )
+            )
+        else:
+            self.log_error("The Ansible worker exited while running the playbook")
+        return (
+            Result.NOT_KEPT,
+            ["{safe_promiser}_failed".format(safe_promiser=promiser)],
+        )
+
+    def protocol_terminate(self):
+        try:
+            if not self._worker_requested:
+                # No promise wants the worker anymore, let it exit now
+                # instead of after WORKER_IDLE_TIMEOUT
+                self._connection.write(json.dumps({"operation": "stop"}) + "\n")
+                self._connection.flush()
+            self._connection.close()
+        except OSError:
+            pass
+        return Result.SUCCESS
+
+
+if __name__ == "__main__" and sys.argv[1:] != ["--worker"]:
+    worker_connection = _connect_to_worker()
+    if worker_connection is not None:
+        AnsibleWorkerClientModule(worker_connection).start()
+        sys.exit(0)
+
 try:
     import ansible.context as context
     from ansible.cli import CLI
@@ -13,7 +177,7 @@ try:
     from ansible.parsing.dataloader import DataLoader
     from ansible.plugins.callback import CallbackBase
     from ansible.vars.manager import VariableManager
-    from ansible.plugins.loader import init_plugin_loader
+    from ansible.plugins.loader import init_plugin_loader, vars_loader
 except ModuleNotFoundError:
 
     class UnavailableAnsiblePromiseTypeModule(PromiseModule):
@@ -33,6 +197,164 @@ except ModuleNotFoundError:
     sys.exit(0)
 
 
+def _file_digest(path):
+    if os.path.isdir(path):
+        try:
+            return hashlib.sha256(
+                "\n".join(sorted(os.listdir(path))).encode()
+            ).hexdigest()
+        except OSError:
+            return ""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+    except OSError:
+        return ""
+    return digest.hexdigest()
+
+
+def _fingerprint(options, paths):
+    """Fingerprint of the promise options and the content of the files
+    Ansible read to run the playbook."""
+    fingerprint = hashlib.sha256(json.dumps(options, sort_keys=True).encode())
+    for path in sorted(paths):
+        fingerprint.update(path.encode() + b"\0" + _file_digest(path).encode())
+    return fingerprint.hexdigest()
+
+
+class RecordingDataLoader(DataLoader):
+    """DataLoader remembering the paths of the YAML files it is asked to
+    load, whether they are already cached or not."""
+
+    recorded_files = None
+
+    def load_from_file(self, file_name, *args, **kwargs):
+        if self.recorded_files is not None:
+            self.recorded_files.add(self.path_dwim(file_name))
+        return super(RecordingDataLoader, self).load_from_file(
+            file_name, *args, **kwargs
+        )
+
+
+def _vars_paths(inventory_path, playbook):
+    """The inventory and the group_vars and host_vars directories Ansible
+    looks for next to it and next to the playbook."""
+    paths = []
+    if inventory_path:
+        paths.append(inventory_path)
+        if not os.path.isdir(inventory_path):
+            paths.extend(_vars_dirs(os.path.dirname(inventory_path)))
+    paths.extend(_vars_dirs(os.path.dirname(os.path.abspath(playbook))))
+    return paths
+
+
+def _vars_dirs(basedir):
+    return [os.path.join(basedir, "group_vars"), os.path.join(basedir, "host_vars")]
+
+
+def _tree_signature(path):
+    """Signatures of the path and of everything below it, so that added and
+    removed files are noticed as well as changed ones."""
+    signature = [(path, _file_signature(path))]
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            entry = os.path.join(root, name)
+            signature.append((entry, _file_signature(entry)))
+    return signature
+
+
+def _vars_caches():
+    """The caches in which the host_group_vars plugin remembers the
+    group_vars and host_vars files it found for the lifetime of the process,
+    None if this version of Ansible doesn't have them."""
+    plugin = vars_loader.get("ansible.builtin.host_group_vars")
+    plugin_module = sys.modules.get(type(plugin).__module__) if plugin else None
+    caches = [getattr(plugin_module, name, None) for name in ("FOUND", "NAK")]
+    if not all(isinstance(cache, (dict, set)) for cache in caches):
+        return None
+    return caches
+
+
+def _forget_vars_files():
+    """Make the host_group_vars plugin look for the group_vars and host_vars
+    files again."""
+    for cache in _vars_caches() or ():
+        cache.clear()
+
+
+class AnsibleContext:
+    """DataLoader for one inventory, shared by all the promises using it so
+    that the playbooks, roles and vars files are only parsed once. Every
+    promise gets its own inventory and variables, the way separate
+    ansible-playbook runs do, so facts, registered variables and hosts or
+    groups added by a playbook don't leak into the next one."""
+
+    def __init__(self, inventory_path):
+        self.inventory_path = inventory_path
+        self.loader = RecordingDataLoader()
+        # Whether the caches of Ansible can be inspected to reload only the
+        # files which changed, which relies on Ansible internals. Otherwise
+        # the context is only used for one promise and nothing is skipped.
+        self.tracks_changes = (
+            isinstance(getattr(self.loader, "_FILE_CACHE", None), dict)
+            and _vars_caches() is not None
+        )
+        # Signatures of the inventory and the vars directories near it and
+        # near the playbooks, by path
+        self.vars_signatures = {}
+        # Signatures of the files parsed and cached by the DataLoader
+        self.file_signatures = {}
+
+    def is_outdated(self, playbook):
+        outdated = False
+        for path in _vars_paths(self.inventory_path, playbook):
+            signature = _tree_signature(path)
+            if self.vars_signatures.setdefault(path, signature) != signature:
+                outdated = True
+        return outdated
+
+    def new_inventory(self):
+        """Load the inventory, returning it with the files it was loaded
+        from."""
+        self.loader.recorded_files = set()
+        try:
+            inventory = InventoryManager(
+                loader=self.loader,
+                sources=(self.inventory_path,) if self.inventory_path else (),
+            )
+            return inventory, self.loader.recorded_files
+        finally:
+            self.loader.recorded_files = None
+
+    def new_variable_manager(self, inventory):
+        return VariableManager(
+            loader=self.loader,
+            inventory=inventory,
+            version_info=CLI.version_info(gitinfo=False),
+        )
+
+    def forget_changed_files(self):
+        """Drop the parsed playbooks, roles, tasks and vars files which
+        changed since they were loaded from the DataLoader cache."""
+        if not self.tracks_changes:
+            return
+        cache = self.loader._FILE_CACHE
+        for path, signature in list(self.file_signatures.items()):
+            if _file_signature(path) != signature:
+                cache.pop(path, None)
+                del self.file_signatures[path]
+
+    def remember_loaded_files(self):
+        if not self.tracks_changes:
+            return
+        for path in self.loader._FILE_CACHE:
+            if path not in self.file_signatures:
+                self.file_signatures[path] = _file_signature(path)
+
+
 class CallbackModule(CallbackBase):
     CALLBACK_VERSION = 1.0
     CALLBACK_TYPE = "stdout"
@@ -42,16 +364,39 @@ class CallbackModule(CallbackBase):
         self.promise = promise
         self.hosts = set()
         self.changed = False
+        # Start time of the tasks running on each host
+        self.started = {}
+        # Duration of every task run, in the order they finished
+        self.timings = []
         super(CallbackModule, self).__init__(*args, **kw)
 
+    def _task_done(self, result, status):
+        host = str(result._host)
+        task = result._task
+        started = self.started.pop((host, task._uuid), None)
+        if started is None:
+            return
+        self.timings.append(
+            {
+                "task": result.task_name,
+                "role": task._role.get_name() if task._role else None,
+                "path": task.get_path(),
+                "host": host,
+                "status": status,
+                "duration": round(time.monotonic() - started, 3),
+            }
+        )
+
     def v2_runner_on_start(self, host, task):
         self.hosts.add(str(host))
+        self.started[(str(host), task._uuid)] = time.monotonic()
         self.promise.log_verbose(
             "Task '" + task.name + "' started on '" + str(host) + "'"
         )
 
     def v2_runner_on_ok(self, result):
         is_changed = result.is_changed()
+        self._task_done(result, "changed" if is_changed else "ok")
         if is_changed:
             self.changed = True
             self.promise.log_info(
@@ -61,11 +406,16 @@ class CallbackModule(CallbackBase):
             self.promise.log_verbose("Task '" + result.task_name + "' didn't change")
 
     def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._task_done(result, "failed")
         self.promise.log_error("Task '" + result.task_name + "' failed")
 
     def v2_runner_on_skipped(self, result):
+        self._task_done(result, "skipped")
         self.promise.log_verbose("Task '" + result.task_name + "' was skipped")
 
+    def v2_runner_on_unreachable(self, result):
+        self._task_done(result, "unreachable")
+
     def v2_playbook_on_stats(self, stats):
         for host in self.hosts:
             summary_dict = stats.summarize(host)
@@ -80,45 +430,57 @@ class CallbackModule(CallbackBase):
                 )
 
 
-class AnsiblePromiseTypeModule(PromiseModule):
+class AnsiblePromiseTypeModule(BaseAnsiblePromiseTypeModule):
     def __init__(self, **kwargs):
-        super(AnsiblePromiseTypeModule, self).__init__(
-            "ansible_promise_module", "0.0.0", **kwargs
-        )
+        super(AnsiblePromiseTypeModule, self).__init__(**kwargs)
 
-        def must_be_absolute(v):
-            if not os.path.isabs(v):
-                raise ValidationError("Must be an absolute path, not '{v}'".format(v=v))
-
-        self.add_attribute(
-            "playbook", str, default_to_promiser=True, validator=must_be_absolute
-        )
-        self.add_attribute("inventory", str, validator=must_be_absolute)
-        self.add_attribute("limit", list, default=[])
-        self.add_attribute("tags", list, default=[])
-        self.add_attribute("become", bool, default=False)
-        self.add_attribute("become_method", str, default="sudo")
-        self.add_attribute("become_user", str, default="root")
-        self.add_attribute("connection", str, default="local")
-        self.add_attribute("forks", int, default=1)
-        self.add_attribute("private_key_file", str, validator=must_be_absolute)
-        self.add_attribute("remote_user", str, default="root")
-
-    def prepare_promiser_and_attributes(self, promiser, attributes):
-        safe_promiser = promiser.replace(",", "_")
-        return (safe_promiser, attributes)
-
-    def validate_promise(self, promiser: str, attributes: Dict, metadata: Dict):
-        return
+        # AnsibleContext for each inventory path used during the agent run
+        self._contexts = {}
+        self._state = None
 
     def evaluate_promise(
         self, promiser: str, attributes: Dict, metadata: Dict
     ) -> Tuple[str, List[str]]:
         model = self.create_attribute_object(promiser, attributes)
+        if model.worker:
+            self._worker_requested = True
 
         classes = []
         result = Result.KEPT
 
+        options = {
+            name: getattr(model, name)
+            for name in (
+                "playbook",
+                "inventory",
+                "limit",
+                "tags",
+                "become",
+                "become_method",
+                "become_user",
+                "connection",
+                "forks",
+                "private_key_file",
+                "remote_user",
+            )
+        }
+        ansible_context = self._get_context(model.inventory, model.playbook)
+        fingerprints = self._get_state("fingerprints")
+        if model.skip_unchanged and not ansible_context.tracks_changes:
+            self.log_verbose(
+                "Can't tell which files this version of Ansible uses, running playbook '{playbook}'".format(
+                    playbook=model.playbook
+                )
+            )
+        elif model.skip_unchanged:
+            if self._is_unchanged(fingerprints.get(promiser), options, model):
+                self.log_verbose(
+                    "Playbook '{playbook}' and the files it uses didn't change since it was last kept, skipping it".format(
+                        playbook=model.playbook
+                    )
+                )
+                return (result, classes)
+
         context.CLIARGS = ImmutableDict(
             tags=model.tags,
             listtags=False,
@@ -142,21 +504,12 @@ class AnsiblePromiseTypeModule(PromiseModule):
             start_at_task=None,
         )
 
-        loader = DataLoader()
-        inventory = InventoryManager(
-            loader=loader,
-            sources=(model.inventory,) if model.inventory else (),
-        )
-        # An empty subset means no host matches, so leave it alone to target
-        # everything, the way ansible-playbook does without --limit.
+        loader = ansible_context.loader
+        ansible_context.forget_changed_files()
+        inventory, inventory_files = ansible_context.new_inventory()
         if model.limit:
             inventory.subset(model.limit)
-
-        variable_manager = VariableManager(
-            loader=loader,
-            inventory=inventory,
-            version_info=CLI.version_info(gitinfo=False),
-        )
+        variable_manager = ansible_context.new_variable_manager(inventory)
         pbex = PlaybookExecutor(
             playbooks=[model.playbook],
             inventory=inventory,
@@ -171,16 +524,270 @@ class AnsiblePromiseTypeModule(PromiseModule):
         pbex._tqm._callback_plugins = [callback]
         pbex._tqm._callbacks_loaded = True
 
-        exit_code = pbex.run()
+        loaded_files = set()
+        loader.recorded_files = loaded_files
+        started = time.time()
+        try:
+            exit_code = pbex.run()
+        finally:
+            loader.recorded_files = None
+            ansible_context.remember_loaded_files()
+        self._report_timings(promiser, model, callback, started)
         if exit_code != 0:
             classes.append("{safe_promiser}_failed".format(safe_promiser=promiser))
             result = Result.NOT_KEPT
         elif callback.changed:
             result = Result.REPAIRED
 
+        if (
+            model.skip_unchanged
+            and ansible_context.tracks_changes
+            and result == Result.KEPT
+        ):
+            # The vars directories too, for added group_vars and host_vars
+            files = loaded_files | inventory_files
+            files.update(_vars_paths(model.inventory, model.playbook))
+            files = sorted(files)
+            fingerprints[promiser] = {
+                "fingerprint": _fingerprint(options, files),
+                "files": files,
+                "timestamp": time.time(),
+            }
+            self._save_state()
+        elif fingerprints.pop(promiser, None) is not None:
+            self._save_state()
+
         return (result, classes)
 
+    def _report_timings(self, promiser, model, callback, started):
+        duration = time.time() - started
+        host_durations = {}
+        for timing in callback.timings:
+            host_durations[timing["host"]] = (
+                host_durations.get(timing["host"], 0) + timing["duration"]
+            )
+
+        self.log_verbose(
+            "Playbook '{playbook}' took {duration:.3f}s".format(
+                playbook=model.playbook, duration=duration
+            )
+        )
+        for host, host_duration in sorted(host_durations.items()):
+            self.log_verbose(
+                "Tasks on '{host}' took {duration:.3f}s".format(
+                    host=host, duration=host_duration
+                )
+            )
+        slowest = sorted(callback.timings, key=lambda t: t["duration"], reverse=True)
+        for timing in slowest[: model.slowest_tasks]:
+            self.log_verbose(
+                "Task '{task}'{role} on '{host}' took {duration:.3f}s".format(
+                    task=timing["task"],
+                    role=(
+                        " of role '{role}'".format(role=timing["role"])
+                        if timing["role"]
+                        else ""
+                    ),
+                    host=timing["host"],
+                    duration=timing["duration"],
+                )
+            )
+
+        if not model.timing_profile:
+            return
+        profile = {
+            "promiser": promiser,
+            "playbook": model.playbook,
+            "started": started,
+            "duration": round(duration, 3),
+            "hosts": {host: round(d, 3) for host, d in host_durations.items()},
+            "tasks": callback.timings,
+        }
+        tmp_path = model.timing_profile + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(profile, f, indent=2)
+            os.replace(tmp_path, model.timing_profile)
+        except OSError as e:
+            self.log_warning(
+                "Failed to write the timing profile '{path}': {error}".format(
+                    path=model.timing_profile, error=e
+                )
+            )
+
+    def _is_unchanged(self, last_kept, options, model):
+        if not isinstance(last_kept, dict):
+            return False
+        try:
+            if time.time() - last_kept["timestamp"] >= model.skip_max_age:
+                return False
+            fingerprint = _fingerprint(options, last_kept["files"])
+            return fingerprint == last_kept["fingerprint"]
+        except (KeyError, TypeError):
+            return False
+
+    def _get_state(self, section):
+        if self._state is None:
+            try:
+                with open(STATE_FILE) as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                self._state = {}
+            if not isinstance(self._state, dict):
+                self._state = {}
+        return self._state.setdefault(section, {})
+
+    def _save_state(self):
+        tmp_path = STATE_FILE + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self._state, f)
+            os.replace(tmp_path, STATE_FILE)
+        except OSError as e:
+            self.log_warning(
+                "Failed to save ansible promise state: {error}".format(error=e)
+            )
+
+    def protocol_terminate(self):
+        if self._worker_requested:
+            self._start_worker()
+        return Result.SUCCESS
+
+    def _start_worker(self):
+        """Start the worker in the background, so the next agent runs pass
+        their promises to it instead of loading Ansible again."""
+        try:
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--worker"],
+                cwd="/",
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError as e:
+            self.log_warning(
+                "Failed to start the Ansible worker: {error}".format(error=e)
+            )
+
+    def evaluate_for_worker_client(self, connection, request):
+        """Evaluate a promise received by the worker, streaming the log
+        messages to the client the same way they are sent to the agent."""
+        self._out = connection
+        self._log_level = request.get("log_level") or "info"
+        promiser = request["promiser"]
+        try:
+            result, classes = self.evaluate_promise(promiser, request["attributes"], {})
+        except Exception as e:
+            self.log_critical(
+                "{error_type}: {error} (Bug in python promise type module)".format(
+                    error_type=type(e).__name__, error=e
+                )
+            )
+            result, classes = Result.ERROR, []
+        connection.write(
+            json.dumps({"result": result, "result_classes": classes}) + "\n"
+        )
+        connection.flush()
+
+    def _get_context(self, inventory_path, playbook):
+        ansible_context = self._contexts.get(inventory_path)
+        if (
+            ansible_context is None
+            or not ansible_context.tracks_changes
+            or ansible_context.is_outdated(playbook)
+        ):
+            if ansible_context is not None and ansible_context.tracks_changes:
+                self.log_verbose(
+                    "Inventory '{inventory}' or its vars files changed, loading them again".format(
+                        inventory=inventory_path
+                    )
+                )
+            else:
+                self.log_debug(
+                    "Loading inventory '{inventory}'".format(inventory=inventory_path)
+                )
+            _forget_vars_files()
+            ansible_context = AnsibleContext(inventory_path)
+            # Remember the current signatures
+            ansible_context.is_outdated(playbook)
+            self._contexts[inventory_path] = ansible_context
+        return ansible_context
+
+
+class AnsibleWorkerRequestHandler(socketserver.BaseRequestHandler):
+    """Handles the connection of one agent run, i.e. the promises evaluated
+    by one AnsibleWorkerClientModule."""
+
+    def handle(self):
+        with self.request.makefile("rw") as connection:
+            for line in connection:
+                request = json.loads(line)
+                operation = request.get("operation")
+                if operation == "hello":
+                    # A different version of the module was installed,
+                    # make way for a worker running it
+                    if request.get("module") != self.server.module_signature:
+                        self.server.stopped = True
+                    result = Result.FAILURE if self.server.stopped else Result.SUCCESS
+                    connection.write(json.dumps({"result": result}) + "\n")
+                    connection.flush()
+                elif operation == "evaluate":
+                    self.server.module.evaluate_for_worker_client(connection, request)
+                elif operation == "stop":
+                    self.server.stopped = True
+                if self.server.stopped:
+                    return
+
+
+class AnsibleWorker(socketserver.UnixStreamServer):
+    """Long-lived process keeping the Ansible runtime and the AnsibleContext
+    objects of AnsiblePromiseTypeModule loaded between agent runs. It serves
+    one agent run at a time and exits after WORKER_IDLE_TIMEOUT seconds
+    without any."""
+
+    timeout = WORKER_IDLE_TIMEOUT
+
+    def __init__(self):
+        self.module = AnsiblePromiseTypeModule()
+        self.module_signature = _module_signature()
+        self.stopped = False
+        super(AnsibleWorker, self).__init__(WORKER_SOCKET, AnsibleWorkerRequestHandler)
+
+    def handle_timeout(self):
+        self.stopped = True
+
+    def serve(self):
+        socket_signature = _file_signature(WORKER_SOCKET)
+        try:
+            while not self.stopped:
+                self.handle_request()
+        finally:
+            self.server_close()
+            # Don't remove the socket of a worker which replaced this one
+            if _file_signature(WORKER_SOCKET) == socket_signature:
+                os.unlink(WORKER_SOCKET)
+
+
+def run_worker():
+    os.umask(0o077)
+    os.makedirs(os.path.dirname(WORKER_SOCKET), exist_ok=True)
+    worker_connection = _connect_to_worker()
+    if worker_connection is not None:
+        # Another worker is already serving this version of the module
+        worker_connection.close()
+        return
+    try:
+        os.unlink(WORKER_SOCKET)
+    except FileNotFoundError:
+        pass
+    AnsibleWorker().serve()
+
 
 if __name__ == "__main__":
     init_plugin_loader()
-    AnsiblePromiseTypeModule().start()
+    if sys.argv[1:] == ["--worker"]:
+        run_worker()
+    else:
+        AnsiblePromiseTypeModule().start()
@@ -0,0 +1,396 @@
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import types
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../libraries/python"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+pytest.importorskip("ansible")
+
+from cfengine_module_library import Result  # noqa: E402
+
+import ansible_promise  # noqa: E402
+from ansible_promise import (  # noqa: E402
+    AnsiblePromiseTypeModule,
+    AnsibleWorkerClientModule,
+)
+
+ansible_promise.init_plugin_loader()
+
+PLAYBOOK = """\
+- hosts: all
+  gather_facts: false
+  roles:
+    - greeter
+  tasks:
+    - name: Say goodbye
+      debug:
+        msg: "goodbye"
+"""
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+@pytest.fixture(autouse=True)
+def state_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "state" / "ansible_promise_state.json")
+    monkeypatch.setattr(ansible_promise, "STATE_FILE", path)
+    return path
+
+
+@pytest.fixture
+def project(tmp_path):
+    """A playbook using a role and group_vars, run on localhost."""
+    root = tmp_path / "project"
+    write(str(root / "inventory.ini"), "localhost ansible_connection=local\n")
+    write(str(root / "group_vars" / "all.yml"), "greeting: hello\n")
+    write(
+        str(root / "roles" / "greeter" / "tasks" / "main.yml"),
+        "- name: Greet\n  debug:\n    msg: '{{ greeting }}'\n",
+    )
+    write(str(root / "playbook.yml"), PLAYBOOK)
+    return root
+
+
+def new_module():
+    module = AnsiblePromiseTypeModule()
+    module._out = io.StringIO()
+    module._log_level = "verbose"
+    return module
+
+
+def evaluate(module, project, **attributes):
+    """Evaluate the promise, returning its result and whether the playbook
+    was run."""
+    attributes.setdefault("inventory", str(project / "inventory.ini"))
+    attributes.setdefault("skip_unchanged", True)
+    module._out = io.StringIO()
+    result, _ = module.evaluate_promise(str(project / "playbook.yml"), attributes, {})
+    return result, "skipping it" not in module._out.getvalue()
+
+
+def test_unchanged_playbook_skipped(project):
+    assert evaluate(new_module(), project) == (Result.KEPT, True)
+    assert evaluate(new_module(), project) == (Result.KEPT, False)
+
+
+def test_playbook_run_without_skip_unchanged(project):
+    assert evaluate(new_module(), project) == (Result.KEPT, True)
+    assert evaluate(new_module(), project, skip_unchanged=False) == (
+        Result.KEPT,
+        True,
+    )
+
+
+@pytest.mark.parametrize(
+    "path, content",
+    [
+        ("playbook.yml", PLAYBOOK.replace("goodbye", "bye")),
+        (
+            "roles/greeter/tasks/main.yml",
+            "- name: Greet\n  debug:\n    msg: '{{ greeting }} there'\n",
+        ),
+        ("group_vars/all.yml", "greeting: hi\n"),
+        ("group_vars/localhost.yml", "greeting: hi\n"),
+        ("host_vars/localhost.yml", "greeting: hi\n"),
+        ("inventory.ini", "localhost ansible_connection=local greeting=hi\n"),
+    ],
+)
+def test_changed_file_runs_playbook(project, path, content):
+    module = new_module()
+    assert evaluate(module, project) == (Result.KEPT, True)
+    assert evaluate(module, project) == (Result.KEPT, False)
+
+    write(str(project / path), content)
+    assert evaluate(module, project) == (Result.KEPT, True)
+    assert evaluate(new_module(), project) == (Result.KEPT, False)
+
+
+def test_skip_max_age_runs_playbook(project, state_file):
+    assert evaluate(new_module(), project, skip_max_age=60) == (Result.KEPT, True)
+    assert evaluate(new_module(), project, skip_max_age=60) == (Result.KEPT, False)
+
+    with open(state_file) as f:
+        state = json.load(f)
+    state["fingerprints"][str(project / "playbook.yml")]["timestamp"] -= 60
+    with open(state_file, "w") as f:
+        json.dump(state, f)
+    assert evaluate(new_module(), project, skip_max_age=60) == (Result.KEPT, True)
+    assert evaluate(new_module(), project, skip_max_age=60) == (Result.KEPT, False)
+
+
+def test_changed_options_run_playbook(project):
+    assert evaluate(new_module(), project) == (Result.KEPT, True)
+    assert evaluate(new_module(), project, tags=["greet"]) == (Result.KEPT, True)
+    assert evaluate(new_module(), project, tags=["greet"]) == (Result.KEPT, False)
+    assert evaluate(new_module(), project, forks=2) == (Result.KEPT, True)
+
+
+def test_fingerprint_covers_options_and_content(project):
+    files = [str(project / "playbook.yml")]
+    fingerprint = ansible_promise._fingerprint({"tags": []}, files)
+
+    assert ansible_promise._fingerprint({"tags": []}, files) == fingerprint
+    assert ansible_promise._fingerprint({"tags": ["greet"]}, files) != fingerprint
+    write(files[0], PLAYBOOK.replace("goodbye", "bye"))
+    assert ansible_promise._fingerprint({"tags": []}, files) != fingerprint
+
+
+def test_failed_playbook_not_skipped(project):
+    write(
+        str(project / "playbook.yml"),
+        PLAYBOOK + "    - name: Fail\n      fail:\n        msg: failing\n",
+    )
+    module = new_module()
+    assert evaluate(module, project)[0] == Result.NOT_KEPT
+    assert evaluate(module, project) == (Result.NOT_KEPT, True)
+
+
+def test_missing_vars_caches_run_playbook(project, monkeypatch):
+    # A version of the plugin without the FOUND and NAK caches
+    plugin = ansible_promise.vars_loader.get("ansible.builtin.host_group_vars")
+    name = type(plugin).__module__
+    monkeypatch.setitem(sys.modules, name, types.ModuleType(name))
+
+    module = new_module()
+    assert evaluate(module, project) == (Result.KEPT, True)
+    assert evaluate(module, project) == (Result.KEPT, True)
+    assert "Can't tell which files" in module._out.getvalue()
+
+
+def test_state_records_loaded_files(project, state_file):
+    started = time.time()
+    evaluate(new_module(), project)
+
+    with open(state_file) as f:
+        last_kept = json.load(f)["fingerprints"][str(project / "playbook.yml")]
+    assert last_kept["timestamp"] >= started
+    for path in (
+        "playbook.yml",
+        "inventory.ini",
+        "group_vars/all.yml",
+        "roles/greeter/tasks/main.yml",
+    ):
+        assert str(project / path) in last_kept["files"]
+
+
+# Runs the worker on the socket and with the state file given as arguments
+WORKER_SCRIPT = """
+import sys
+sys.path.append({library!r})
+sys.path.insert(0, {directory!r})
+import ansible_promise
+ansible_promise.WORKER_SOCKET, ansible_promise.STATE_FILE = sys.argv[1:]
+ansible_promise.init_plugin_loader()
+ansible_promise.run_worker()
+""".format(
+    library=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "../../libraries/python"
+    ),
+    directory=os.path.dirname(os.path.abspath(__file__)),
+)
+
+
+@pytest.fixture
+def worker_socket(tmp_path, monkeypatch):
+    path = str(tmp_path / "worker.sock")
+    monkeypatch.setattr(ansible_promise, "WORKER_SOCKET", path)
+    return path
+
+
+@pytest.fixture
+def start_worker(tmp_path, worker_socket, state_file):
+    processes = []
+
+    def start():
+        with open(str(tmp_path / "worker.log"), "ab") as log:
+            process = subprocess.Popen(
+                [sys.executable, "-c", WORKER_SCRIPT, worker_socket, state_file],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=log,
+            )
+        processes.append(process)
+        deadline = time.monotonic() + 30
+        while ansible_promise._connect_to_worker() is None:
+            assert process.poll() is None, "The worker exited"
+            assert time.monotonic() < deadline, "The worker didn't start"
+            time.sleep(0.05)
+        return process
+
+    yield start
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def new_client():
+    """Module of an agent run connected to the worker."""
+    connection = ansible_promise._connect_to_worker()
+    assert connection is not None
+    module = AnsibleWorkerClientModule(connection)
+    module._out = io.StringIO()
+    module._log_level = "debug"
+    return module
+
+
+def evaluate_in_worker(module, project, **attributes):
+    attributes.setdefault("inventory", str(project / "inventory.ini"))
+    attributes.setdefault("worker", True)
+    module._out = io.StringIO()
+    return module.evaluate_promise(str(project / "playbook.yml"), attributes, {})
+
+
+def test_worker_evaluates_promises(project, start_worker):
+    start_worker()
+    client = new_client()
+
+    assert evaluate_in_worker(client, project) == (Result.KEPT, [])
+    # Log messages of the tasks are streamed back to the agent
+    assert "log_verbose=Task 'Greet' didn't change" in client._out.getvalue()
+
+    write(
+        str(project / "playbook.yml"),
+        PLAYBOOK + "    - name: Fail\n      fail:\n        msg: failing\n",
+    )
+    result, classes = evaluate_in_worker(client, project)
+    assert result == Result.NOT_KEPT
+    assert classes == [str(project / "playbook.yml") + "_failed"]
+    assert "log_error=Task 'Fail' failed" in client._out.getvalue()
+    client.protocol_terminate()
+
+
+def test_worker_reuses_context(project, start_worker):
+    start_worker()
+    outputs = []
+    for _ in range(2):
+        client = new_client()
+        for _ in range(2):
+            assert evaluate_in_worker(client, project) == (Result.KEPT, [])
+            outputs.append(client._out.getvalue())
+        client.protocol_terminate()
+
+    # The inventory is only loaded by the first promise of the first agent run
+    assert [
+        "Loading inventory '{inventory}'".format(inventory=project / "inventory.ini")
+        in output
+        for output in outputs
+    ] == [True, False, False, False]
+
+
+def test_worker_stops_when_not_requested(project, start_worker, worker_socket):
+    process = start_worker()
+    client = new_client()
+    assert evaluate_in_worker(client, project, worker=False) == (Result.KEPT, [])
+    client.protocol_terminate()
+
+    assert process.wait(timeout=30) == 0
+    assert not os.path.exists(worker_socket)
+    assert ansible_promise._connect_to_worker() is None
+
+
+def test_no_worker_without_socket(worker_socket):
+    assert ansible_promise._connect_to_worker() is None
+
+
+def test_stale_worker_socket(project, start_worker, worker_socket):
+    # Socket left behind by a worker which was killed
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(worker_socket)
+    stale.close()
+    assert ansible_promise._connect_to_worker() is None
+
+    # The promises are then evaluated in the agent's own process
+    assert evaluate(new_module(), project, skip_unchanged=False) == (Result.KEPT, True)
+
+    # And a new worker replaces the stale socket
+    start_worker()
+    client = new_client()
+    assert evaluate_in_worker(client, project) == (Result.KEPT, [])
+    client.protocol_terminate()
+
+
+def test_worker_of_other_module_version_not_used(start_worker, monkeypatch):
+    process = start_worker()
+    monkeypatch.setattr(ansible_promise, "_module_signature", lambda: [0, 0, 0])
+
+    assert ansible_promise._connect_to_worker() is None
+    # It makes way for a worker running the installed module
+    assert process.wait(timeout=30) == 0
+
+
+def test_timing_profile(project, tmp_path):
+    write(
+        str(project / "playbook.yml"),
+        PLAYBOOK
+        + "    - name: Sleep\n      command: sleep 0.5\n"
+        + "    - name: Nap\n      command: sleep 0.2\n",
+    )
+    profile_path = str(tmp_path / "profile.json")
+    module = new_module()
+    result, _ = evaluate(
+        module,
+        project,
+        skip_unchanged=False,
+        slowest_tasks=2,
+        timing_profile=profile_path,
+    )
+    assert result == Result.REPAIRED
+
+    with open(profile_path) as f:
+        profile = json.load(f)
+    assert set(profile) == {
+        "promiser",
+        "playbook",
+        "started",
+        "duration",
+        "hosts",
+        "tasks",
+    }
+    assert profile["promiser"] == profile["playbook"] == str(project / "playbook.yml")
+    assert list(profile["hosts"]) == ["localhost"]
+    assert profile["duration"] >= profile["hosts"]["localhost"] >= 0.7
+    # Every task, in the order they ran
+    tasks = profile["tasks"]
+    assert [t["task"] for t in tasks] == ["Greet", "Say goodbye", "Sleep", "Nap"]
+    for task in tasks:
+        assert set(task) == {"task", "role", "path", "host", "status", "duration"}
+        assert task["host"] == "localhost"
+    assert [t["role"] for t in tasks] == ["greeter", None, None, None]
+    assert [t["status"] for t in tasks] == ["ok", "ok", "changed", "changed"]
+    assert tasks[0]["path"].startswith(
+        str(project / "roles" / "greeter" / "tasks" / "main.yml") + ":"
+    )
+
+    # The slowest_tasks slowest ones are logged, slowest first
+    logged = [
+        line.split("'")[1]
+        for line in module._out.getvalue().splitlines()
+        if line.startswith("log_verbose=Task '") and "' took " in line
+    ]
+    slowest = sorted(tasks, key=lambda t: t["duration"], reverse=True)
+    assert logged == [t["task"] for t in slowest[:2]] == ["Sleep", "Nap"]
+
+
+def test_timing_profile_write_failure(project, tmp_path):
+    module = new_module()
+    result, _ = evaluate(
+        module,
+        project,
+        skip_unchanged=False,
+        timing_profile=str(tmp_path / "missing" / "profile.json"),
+    )
+    assert result == Result.KEPT
+    assert "log_warning=Failed to write the timing profile" in module._out.getvalue()
@@ -28,7 +28,12 @@
 # Comment field alongside the bundle and policy file, giving auditors a
 # direct pointer back to the exact promise that made the change.
 
+import configparser
+import glob
+import json
+import os
 import sys
+import time
 import dnf
 import dnf.exceptions
 import re
@@ -40,6 +45,24 @@ try:
 except (ImportError, ModuleNotFoundError):
     dnf.module = None  # type: ignore
 
+# Module state persisted by libdnf, one INI file per module
+MODULES_DIR = "/etc/dnf/modules.d"
+
+# Repository metadata cached by DNF
+DNF_CACHE_DIR = "/var/cache/dnf"
+
+# State kept across agent runs:
+#   "metadata_refreshed": last forced metadata refresh, as {repo id: timestamp}
+#   "profile_packages": installed profiles found up to date by the last full
+#                       check, as {"module:stream/profile": {"packages": [...],
+#                       "labels": {package: [modularitylabels]},
+#                       "metadata": repository metadata signature}}
+STATE_FILE = "/var/cfengine/state/appstreams_promise_state.json"
+
+# Returned by _run_transaction() for a batched promise, whose outcome is only
+# known once the batch is committed
+QUEUED = "queued"
+
 
 class AppStreamsPromiseTypeModule(PromiseModule):
     def __init__(self, **kwargs):
@@ -76,18 +99,61 @@ class AppStreamsPromiseTypeModule(PromiseModule):
             required=False,
             default=[],
         )
+        self.add_attribute("batch", bool, required=False, default=False)
+        self.add_attribute(
+            "max_parallel_downloads",
+            int,
+            required=False,
+            validator=lambda x: self._validate_max_parallel_downloads(x),
+        )
+        self.add_attribute(
+            "metadata_max_age",
+            int,
+            required=False,
+            default=0,
+            validator=lambda x: self._validate_metadata_max_age(x),
+        )
 
         # Standard CFEngine promise attributes — passed through by the agent
         # and used to populate the DNF history comment for audit traceability.
         self.add_attribute("handle", str, required=False)
         self.add_attribute("comment", str, required=False)
 
+        # DNF Base shared by the promises of this agent session, see _get_base()
+        self._base = None
+        self._base_uses_cached_metadata = False
+        self._package_index = None
+        self._state = None
+        self._refreshed_repos = set()
+
+        # Operations of batched promises waiting for the shared transaction,
+        # see _run_transaction() and _commit_batch()
+        self._batching = False
+        self._batch = []
+        self._batch_failed = False
+        self._promise_description = ""
+        self._promise_options = []
+        self._max_parallel_downloads = None
+
     def _validate_state(self, value):
         accepted = ("enabled", "disabled", "installed", "removed", "default", "reset")
         if value not in accepted:
             accepted_str = "', '".join(accepted)
             raise ValidationError(f"State attribute must be '{accepted_str}'")
 
+    def _validate_metadata_max_age(self, value):
+        if value < 0:
+            raise ValidationError(
+                f"metadata_max_age must be 0 or more seconds, not {value}"
+            )
+
+    def _validate_max_parallel_downloads(self, value):
+        # The same bounds DNF enforces for its max_parallel_downloads option
+        if not 1 <= value <= 20:
+            raise ValidationError(
+                f"max_parallel_downloads must be between 1 and 20, not {value}"
+            )
+
     def _validate_module_name(self, name):
         self._validate_identifier(name, "module name")
 
@@ -117,6 +183,21 @@ class AppStreamsPromiseTypeModule(PromiseModule):
         stream = attributes.get("stream", None)
         profile = attributes.get("profile", None)
         options = attributes.get("options", [])
+        metadata_max_age = attributes.get("metadata_max_age", 0)
+        batch = attributes.get("batch", False)
+
+        # A promise outside of the batch may depend on what the batch changes,
+        # and the DNF options of the shared Base apply to the whole batch
+        if (
+            self._batch
+            and (not batch or options != self._batch[0]["options"])
+            and not self._commit_batch()
+        ):
+            self._batch_failed = True
+
+        # Most runs are KEPT, check that without loading the sack first
+        if self._is_kept_without_sack(module_name, state, stream, profile):
+            return Result.KEPT
 
         # Build a descriptive argv so dnf history records a meaningful
         # "Command Line" entry instead of leaving it blank.
@@ -129,21 +210,91 @@ class AppStreamsPromiseTypeModule(PromiseModule):
             _cmdline.append(f"options={options!r}")
         _orig_argv, sys.argv = sys.argv, _cmdline
 
+        handle = attributes.get("handle", "")
+        cf_comment = attributes.get("comment", "")
+        extra = []
+        if handle:
+            extra.append(f"handle: {handle}")
+        if cf_comment:
+            extra.append(f"comment: {cf_comment}")
+        extra_part = " | " + ", ".join(extra) if extra else ""
+        self._batching = batch
+        self._max_parallel_downloads = attributes.get("max_parallel_downloads")
+        self._promise_options = options
+        self._promise_description = f"{module_name} state={state}{extra_part}"
+
+        result = Result.NOT_KEPT
+        try:
+            force_refresh = False
+            while True:
+                base = self._get_base(metadata_max_age, force_refresh)
+                # The Base is shared, so the comment has to be set for each promise
+                base.conf.comment = (
+                    f"CFEngine appstreams promise: {self._promise_description}"
+                )
+
+                if base.sack is None:
+                    self.log_error("DNF sack is not available")
+                    return Result.NOT_KEPT
+                if not hasattr(base.sack, "_moduleContainer"):
+                    self.log_error("DNF sack has no module container")
+                    return Result.NOT_KEPT
+
+                try:
+                    result = self._evaluate_module(
+                        base, module_name, state, stream, profile, options
+                    )
+                    if result == QUEUED:
+                        # Not applied yet, cf-agent must not act on it as if
+                        # it was repaired
+                        return Result.NOT_KEPT
+                    return result
+                except dnf.exceptions.DownloadError as e:
+                    # Packages missing from the mirror usually mean that the
+                    # cached metadata is outdated, retry once with fresh one.
+                    if force_refresh or not self._base_uses_cached_metadata:
+                        raise
+                    self.log_verbose(
+                        f"Failed to download packages with cached repository "
+                        f"metadata, retrying with refreshed metadata: {e}"
+                    )
+                    self._close_base()
+                    force_refresh = True
+        finally:
+            # Anything but a KEPT promise may have changed the system, the
+            # goal or the configuration (options) of the shared Base, so the
+            # next promise needs a new one with a fresh sack. A pending batch
+            # keeps it until the batch is committed, unless the promise failed
+            # and may have left some of its changes in the goal.
+            if result == QUEUED:
+                pass
+            elif result != Result.KEPT and self._batch:
+                self._discard_batch()
+            elif result != Result.KEPT:
+                self._close_base()
+            sys.argv = _orig_argv
+
+    def _get_base(self, metadata_max_age=0, force_refresh=False):
+        """Return the DNF Base shared by the promises of this agent session,
+        creating it and loading its sack on first use, or when the metadata
+        it was loaded with is older than metadata_max_age seconds."""
+        if self._base is not None:
+            if (
+                self._batch
+                or not force_refresh
+                and not any(
+                    self._repo_metadata_expired(repo.id, metadata_max_age)
+                    for repo in self._base.repos.iter_enabled()
+                )
+            ):
+                return self._base
+            self._close_base()
+
         base = dnf.Base()
         try:
-            # Read configuration first so comment is set before plugins read it
+            # The comment is only read when a transaction runs, each promise
+            # sets its own in evaluate_promise()
             base.conf.assumeyes = True
-            handle = attributes.get("handle", "")
-            cf_comment = attributes.get("comment", "")
-            extra = []
-            if handle:
-                extra.append(f"handle: {handle}")
-            if cf_comment:
-                extra.append(f"comment: {cf_comment}")
-            extra_part = " | " + ", ".join(extra) if extra else ""
-            base.conf.comment = (
-                f"CFEngine appstreams promise: {module_name} state={state}{extra_part}"
-            )
 
             # Load DNF plugins so transactions are recorded like the CLI would.
             # configure_plugins() is intentionally omitted: it opens a history
@@ -158,105 +309,402 @@ class AppStreamsPromiseTypeModule(PromiseModule):
             # Force metadata expiry so DNF re-downloads repo metadata rather
             # than using stale cache entries that may point to RPM paths from
             # previously interrupted transactions that no longer exist on disk.
+            # Metadata refreshed less than metadata_max_age seconds ago (and
+            # anything refreshed earlier in this session) is used as cached.
+            refreshed = []
+            self._base_uses_cached_metadata = False
             if base.repos:
                 for repo in base.repos.iter_enabled():
-                    repo.metadata_expire = 0
+                    if force_refresh or self._repo_metadata_expired(
+                        repo.id, metadata_max_age
+                    ):
+                        repo.metadata_expire = 0
+                        refreshed.append(repo.id)
+                    else:
+                        repo.metadata_expire = -1
+                        self._base_uses_cached_metadata = True
 
             base.fill_sack(load_system_repo=True)
+        except BaseException:
+            base.close()
+            raise
+
+        if refreshed:
+            now = time.time()
+            for repo_id in refreshed:
+                self._get_state("metadata_refreshed")[repo_id] = now
+            self._refreshed_repos.update(refreshed)
+            self._save_state()
+        self._base = base
+        return base
+
+    def _repo_metadata_expired(self, repo_id, metadata_max_age):
+        if repo_id in self._refreshed_repos:
+            return False
+        refreshed_at = self._get_state("metadata_refreshed").get(repo_id, 0)
+        return time.time() - refreshed_at >= metadata_max_age
 
-            if base.sack is None:
-                self.log_error("DNF sack is not available")
-                return Result.NOT_KEPT
-            if not hasattr(base.sack, "_moduleContainer"):
-                self.log_error("DNF sack has no module container")
+    def _get_state(self, section):
+        if self._state is None:
+            try:
+                with open(STATE_FILE) as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                self._state = {}
+            if not isinstance(self._state, dict):
+                self._state = {}
+        return self._state.setdefault(section, {})
+
+    def _save_state(self):
+        tmp_path = STATE_FILE + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self._state, f)
+            os.replace(tmp_path, STATE_FILE)
+        except OSError as e:
+            self.log_warning(f"Failed to save appstreams promise state: {e}")
+
+    def _close_base(self):
+        self._package_index = None
+        if self._base is not None:
+            base, self._base = self._base, None
+            base.close()
+
+    def protocol_terminate(self):
+        if self._batch and not self._commit_batch():
+            self._batch_failed = True
+        self._close_base()
+        return Result.FAILURE if self._batch_failed else Result.SUCCESS
+
+    def _run_transaction(self, base, verify, allow_erasing=False, download=False):
+        """Resolve and run the transaction for the operation the promise put
+        in the goal, then return verify(). In batch mode the operation is
+        queued instead, and QUEUED is returned."""
+        if self._batching:
+            self._batch.append(
+                {
+                    "description": self._promise_description,
+                    "argv": sys.argv,
+                    "verify": verify,
+                    "allow_erasing": allow_erasing,
+                    "download": download,
+                    "options": self._promise_options,
+                    "max_parallel_downloads": self._max_parallel_downloads,
+                }
+            )
+            self.log_info(
+                f"Queued {self._promise_description} for the batched transaction, "
+                f"not kept until the batch is committed"
+            )
+            return QUEUED
+
+        base.resolve(allow_erasing=allow_erasing)
+
+        # Explicitly download packages before the transaction. Without this,
+        # do_transaction() uses paths resolved during fill_sack(), which may
+        # point to stale entries from a previously interrupted transaction that
+        # no longer exist on disk, causing a FileNotFoundError.
+        if download:
+            self._download_packages(base, self._max_parallel_downloads)
+
+        base.do_transaction()
+        return verify()
+
+    def _download_packages(self, base, max_parallel_downloads=None):
+        """Download the packages the resolved transaction installs, reusing
+        the ones already in the local cache (e.g. from an interrupted run),
+        and report how much was downloaded and how long it took."""
+        pkgs = list(base.transaction.install_set)
+        if not pkgs:
+            return
+        if max_parallel_downloads:
+            base.conf.max_parallel_downloads = max_parallel_downloads
+        # DNF skips verified packages from the cache too, but doesn't say so
+        cached = [pkg for pkg in pkgs if pkg.verifyLocalPkg()]
+        remote = [pkg for pkg in pkgs if pkg not in cached]
+        if cached:
+            self.log_verbose(
+                f"Reusing {len(cached)} package(s) from the local package cache"
+            )
+        if not remote:
+            return
+        size = sum(pkg.downloadsize or 0 for pkg in remote)
+        start = time.monotonic()
+        base.download_packages(remote)
+        elapsed = time.monotonic() - start
+        self.log_info(
+            f"Downloaded {len(remote)} package(s), {size} bytes, "
+            f"in {elapsed:.1f} seconds"
+        )
+
+    def _commit_batch(self):
+        """Resolve the operations of all batched promises together and run
+        them in one transaction. Returns False if any of them failed."""
+        batch, self._batch = self._batch, []
+        base = self._base
+        descriptions = "; ".join(entry["description"] for entry in batch)
+        base.conf.comment = f"CFEngine appstreams promises: {descriptions}"
+        _orig_argv = sys.argv
+        sys.argv = [arg for entry in batch for arg in entry["argv"]]
+        try:
+            self.log_verbose(f"Running the batched transaction for {descriptions}")
+            base.resolve(allow_erasing=any(e["allow_erasing"] for e in batch))
+            if any(entry["download"] for entry in batch):
+                self._download_packages(
+                    base,
+                    max(
+                        (
+                            entry["max_parallel_downloads"]
+                            for entry in batch
+                            if entry["max_parallel_downloads"]
+                        ),
+                        default=None,
+                    ),
+                )
+            base.do_transaction()
+            results = [entry["verify"]() for entry in batch]
+        except Exception as e:
+            # libdnf raises RuntimeError as well as the dnf exceptions
+            self.log_error(f"Batched transaction failed: {e}")
+            for entry in batch:
+                self.log_error(f"Not applied: {entry['description']}")
+            return False
+        finally:
+            sys.argv = _orig_argv
+            self._close_base()
+        return all(result == Result.REPAIRED for result in results)
+
+    def _discard_batch(self):
+        """Drop the pending batch together with the shared Base, whose goal
+        and module state may hold partial changes of a failed promise. The
+        module state of batched operations is only saved by the transaction,
+        so nothing of the batch is applied."""
+        batch, self._batch = self._batch, []
+        self.log_error("Discarding the batched transaction after a failed promise")
+        for entry in batch:
+            self.log_error(f"Not applied: {entry['description']}")
+        self._batch_failed = True
+        self._close_base()
+
+    def _save_module_state(self, mpc):
+        # do_transaction() saves it for a batch, which may still be discarded
+        if not self._batching:
+            mpc.save()
+
+    def _evaluate_module(self, base, module_name, state, stream, profile, options):
+        mpc = base.sack._moduleContainer
+
+        # Resolve "default" stream/profile to concrete values
+        if stream == "default":
+            stream = mpc.getDefaultStream(module_name)
+            if not stream:
+                self.log_error(f"No default stream found for module {module_name}")
                 return Result.NOT_KEPT
-            mpc = base.sack._moduleContainer
+            self.log_verbose(f"Resolved 'default' stream to '{stream}'")
 
-            # Resolve "default" stream/profile to concrete values
-            if stream == "default":
-                stream = mpc.getDefaultStream(module_name)
-                if not stream:
-                    self.log_error(f"No default stream found for module {module_name}")
-                    return Result.NOT_KEPT
-                self.log_verbose(f"Resolved 'default' stream to '{stream}'")
-
-            if profile == "default":
-                resolved_stream = stream or mpc.getDefaultStream(module_name)
-                profiles = mpc.getDefaultProfiles(module_name, resolved_stream)
-                profile = profiles[0] if profiles else None
-                if not profile:
-                    self.log_error(f"No default profile found for module {module_name}")
-                    return Result.NOT_KEPT
-                self.log_verbose(f"Resolved 'default' profile to '{profile}'")
-
-            current_state = self._get_module_state(mpc, module_name)
-
-            if state == "enabled":
-                if current_state == "enabled":
-                    already_correct = True
-                    if stream:
-                        try:
-                            already_correct = (
-                                mpc.getEnabledStream(module_name) == stream
-                            )
-                        except RuntimeError:
-                            pass  # cannot verify stream, assume correct
-                    if already_correct:
-                        self.log_verbose(f"Module {module_name} is already enabled")
-                        return Result.KEPT
-                return self._enable_module(mpc, base, module_name, stream)
-
-            elif state == "disabled":
-                if current_state == "disabled":
-                    self.log_verbose(f"Module {module_name} is already disabled")
+        if profile == "default":
+            resolved_stream = stream or mpc.getDefaultStream(module_name)
+            profiles = mpc.getDefaultProfiles(module_name, resolved_stream)
+            profile = profiles[0] if profiles else None
+            if not profile:
+                self.log_error(f"No default profile found for module {module_name}")
+                return Result.NOT_KEPT
+            self.log_verbose(f"Resolved 'default' profile to '{profile}'")
+
+        current_state = self._get_module_state(mpc, module_name)
+
+        if state == "enabled":
+            if current_state == "enabled":
+                already_correct = True
+                if stream:
+                    try:
+                        already_correct = mpc.getEnabledStream(module_name) == stream
+                    except RuntimeError:
+                        pass  # cannot verify stream, assume correct
+                if already_correct:
+                    self.log_verbose(f"Module {module_name} is already enabled")
                     return Result.KEPT
-                return self._disable_module(mpc, base, module_name)
+            return self._enable_module(mpc, base, module_name, stream)
 
-            elif state == "installed":
-                # Check if we need to switch streams
-                try:
-                    enabled_stream = mpc.getEnabledStream(module_name)
-                    if stream and enabled_stream and enabled_stream != stream:
-                        # Stream switch needed
-                        self.log_info(
-                            f"Switching module {module_name} from stream "
-                            f"{enabled_stream} to {stream}"
-                        )
-                        return self._switch_module(
-                            mpc, base, module_name, stream, profile, options
-                        )
-                except RuntimeError:
-                    # Module not enabled yet, proceed with normal install
-                    pass
-
-                if self._is_module_installed_with_packages(
-                    mpc, base, module_name, stream, profile
-                ):
-                    self.log_verbose(
-                        f"Module {module_name} (stream: {stream}, "
-                        f"profile: {profile}) is already present"
+        elif state == "disabled":
+            if current_state == "disabled":
+                self.log_verbose(f"Module {module_name} is already disabled")
+                return Result.KEPT
+            return self._disable_module(mpc, base, module_name)
+
+        elif state == "installed":
+            # Check if we need to switch streams
+            try:
+                enabled_stream = mpc.getEnabledStream(module_name)
+                if stream and enabled_stream and enabled_stream != stream:
+                    # Stream switch needed
+                    self.log_info(
+                        f"Switching module {module_name} from stream "
+                        f"{enabled_stream} to {stream}"
                     )
-                    return Result.KEPT
-                return self._install_module(
-                    mpc, base, module_name, stream, profile, options
+                    return self._switch_module(
+                        mpc, base, module_name, stream, profile, options
+                    )
+            except RuntimeError:
+                # Module not enabled yet, proceed with normal install
+                pass
+
+            if self._is_module_installed_with_packages(
+                mpc, base, module_name, stream, profile
+            ):
+                self.log_verbose(
+                    f"Module {module_name} (stream: {stream}, "
+                    f"profile: {profile}) is already present"
                 )
+                return Result.KEPT
+            return self._install_module(
+                mpc, base, module_name, stream, profile, options
+            )
 
-            elif state == "removed":
-                if current_state in ("removed", "disabled"):
-                    self.log_verbose(
-                        f"Module {module_name} is already absent or disabled"
-                    )
-                    return Result.KEPT
-                return self._remove_module(mpc, base, module_name, stream, profile)
+        elif state == "removed":
+            if current_state in ("removed", "disabled"):
+                self.log_verbose(f"Module {module_name} is already absent or disabled")
+                return Result.KEPT
+            return self._remove_module(mpc, base, module_name, stream, profile)
+
+        elif state in ("default", "reset"):
+            return self._reset_module(mpc, base, module_name)
+
+        self.log_error(f"Unexpected state '{state}' for module {module_name}")
+        return Result.NOT_KEPT
+
+    def _read_module_file(self, module_name):
+        """Return the state libdnf persisted for the module as a dict with
+        "state", "stream" and "profiles" keys, or None if it can't be read."""
+        if not os.path.isdir(MODULES_DIR):
+            return None
+        path = os.path.join(MODULES_DIR, f"{module_name}.module")
+        if not os.path.exists(path):
+            # Never enabled nor disabled, i.e. in the default state
+            return {"state": "", "stream": "", "profiles": []}
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            parser.read(path)
+        except configparser.Error:
+            return None
+        if not parser.has_section(module_name):
+            return None
+        section = parser[module_name]
+        return {
+            "state": section.get("state", "").strip(),
+            "stream": section.get("stream", "").strip(),
+            "profiles": [
+                p.strip() for p in section.get("profiles", "").split(",") if p.strip()
+            ],
+        }
+
+    def _is_kept_without_sack(self, module_name, state, stream, profile):
+        """Decide from /etc/dnf/modules.d and the RPM database whether the
+        promise is KEPT. False means a change may be needed, or that it can't
+        be decided this way, and the full check against the sack is done."""
+        if stream == "default" or profile == "default":
+            return False
+        persisted = self._read_module_file(module_name)
+        if persisted is None:
+            return False
 
-            elif state in ("default", "reset"):
-                return self._reset_module(mpc, base, module_name)
+        if state == "enabled":
+            kept = persisted["state"] == "enabled" and (
+                not stream or persisted["stream"] == stream
+            )
+        elif state == "disabled":
+            kept = persisted["state"] == "disabled"
+        elif state in ("default", "reset"):
+            kept = persisted["state"] == "" and not persisted["stream"]
+        elif state == "removed":
+            kept = persisted["state"] in ("", "disabled") and not persisted["profiles"]
+        elif state == "installed":
+            # The packages of a profile and their upgrades are only known from
+            # the module metadata. The last full check found the recorded
+            # packages installed without upgrades, which still holds while
+            # neither the installed packages nor the metadata changed.
+            recorded = self._get_state("profile_packages").get(
+                f"{module_name}:{stream}/{profile}"
+            )
+            kept = (
+                bool(stream and profile)
+                and isinstance(recorded, dict)
+                and bool(recorded.get("packages"))
+                and persisted["state"] == "enabled"
+                and persisted["stream"] == stream
+                and profile in persisted["profiles"]
+                and recorded.get("metadata") == self._metadata_signature()
+                and self._are_packages_installed_from_stream(
+                    module_name, stream, recorded["packages"], recorded.get("labels")
+                )
+            )
+        else:
+            kept = False
 
-            self.log_error(f"Unexpected state '{state}' for module {module_name}")
-            return Result.NOT_KEPT
-        finally:
-            base.close()
-            sys.argv = _orig_argv
+        if kept:
+            self.log_verbose(f"Module {module_name} is already {state}")
+        return kept
+
+    def _are_packages_installed_from_stream(
+        self, module_name, stream, packages, recorded_labels
+    ):
+        """Check in the RPM database that the packages are installed from the
+        given module stream, which also rules out leftovers of another stream,
+        and from the same module versions as when they were recorded."""
+        labels = self._get_modularity_labels(packages)
+        if labels is None or labels != recorded_labels:
+            return False
+        label_prefix = f"{module_name}:{stream}:"
+        return all(
+            any(label.startswith(label_prefix) for label in package_labels)
+            for package_labels in labels.values()
+        )
+
+    def _get_modularity_labels(self, packages):
+        """Return the modularity labels of the installed packages from the
+        RPM database, as {package: [labels]}, or None without rpm."""
+        try:
+            import rpm
+        except ImportError:
+            return None
+        ts = rpm.TransactionSet()
+        labels = {}
+        for pkg in packages:
+            package_labels = [hdr["modularitylabel"] for hdr in ts.dbMatch("name", pkg)]
+            labels[pkg] = sorted(
+                label.decode() if isinstance(label, bytes) else label or ""
+                for label in package_labels
+            )
+        return labels
+
+    def _metadata_signature(self):
+        """Modification times and sizes of the cached repository metadata,
+        which change whenever DNF refreshes it."""
+        signature = []
+        for path in sorted(glob.glob(f"{DNF_CACHE_DIR}/*/repodata/repomd.xml")):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signature.append([path, st.st_mtime_ns, st.st_size])
+        return signature
+
+    def _remember_profile_packages(self, module_name, stream, profile, packages):
+        labels = self._get_modularity_labels(packages)
+        if labels is None:
+            # The check without the sack needs the RPM database anyway
+            return
+        key = f"{module_name}:{stream}/{profile}"
+        entry = {
+            "packages": list(packages),
+            "labels": labels,
+            "metadata": self._metadata_signature(),
+        }
+        recorded = self._get_state("profile_packages")
+        if recorded.get(key) != entry:
+            recorded[key] = entry
+            self._save_state()
 
     def _get_module_state(self, mpc, module_name):
         state = mpc.getModuleState(module_name)
@@ -307,27 +755,41 @@ class AppStreamsPromiseTypeModule(PromiseModule):
                 mpc, module_name, target_stream, profile_name
             )
             if packages:
-                installed_query = base.sack.query().installed()
-                upgrade_query = base.sack.query().upgrades()
-                for pkg in packages:
-                    if not installed_query.filter(name=pkg):
-                        self.log_verbose(
-                            f"Profile '{profile_name}' is marked installed but "
-                            f"package '{pkg}' is not present on the system"
-                        )
-                        return False
-                    # If an upgrade is available the package is from an older
-                    # stream — treat as not converged so _install_module runs
-                    # and upgrades to the enabled stream's version.
-                    if upgrade_query.filter(name=pkg):
-                        self.log_verbose(
-                            f"Package '{pkg}' has an available upgrade from "
-                            f"stream '{target_stream}', needs repair"
-                        )
-                        return False
+                packages = list(packages)
+                installed, upgradable = self._get_package_index(base)
+                missing = [pkg for pkg in packages if pkg not in installed]
+                if missing:
+                    self.log_verbose(
+                        f"Profile '{profile_name}' is marked installed but "
+                        f"package '{missing[0]}' is not present on the system"
+                    )
+                    return False
+                # If an upgrade is available the package is from an older
+                # stream — treat as not converged so _install_module runs
+                # and upgrades to the enabled stream's version.
+                outdated = sorted(upgradable.intersection(packages))
+                if outdated:
+                    self.log_verbose(
+                        f"Package '{outdated[0]}' has an available upgrade from "
+                        f"stream '{target_stream}', needs repair"
+                    )
+                    return False
+                self._remember_profile_packages(
+                    module_name, target_stream, profile_name, packages
+                )
 
         return True
 
+    def _get_package_index(self, base):
+        """Return the names of the installed packages and of the installed
+        packages with an available upgrade. Both are computed in one pass over
+        the sack and reused until the shared Base is closed."""
+        if self._package_index is None:
+            installed = {pkg.name for pkg in base.sack.query().installed()}
+            upgradable = {pkg.name for pkg in base.sack.query().upgrades()}
+            self._package_index = (installed, upgradable)
+        return self._package_index
+
     def _enable_module(self, mpc, base, module_name, stream):
         """Enable a module stream without installing any packages."""
         target_stream = stream or mpc.getDefaultStream(module_name)
@@ -338,29 +800,35 @@ class AppStreamsPromiseTypeModule(PromiseModule):
             return Result.NOT_KEPT
 
         mpc.enable(module_name, target_stream)
-        mpc.save()
+        self._save_module_state(mpc)
         mpc.moduleDefaultsResolve()
-        base.resolve()
-        base.do_transaction()
-        if mpc.isEnabled(module_name, target_stream):
-            self.log_info(f"Module {module_name}:{target_stream} enabled successfully")
-            return Result.REPAIRED
-        else:
-            self.log_error(f"Failed to enable module {module_name}:{target_stream}")
-            return Result.NOT_KEPT
+
+        def verify():
+            if mpc.isEnabled(module_name, target_stream):
+                self.log_info(
+                    f"Module {module_name}:{target_stream} enabled successfully"
+                )
+                return Result.REPAIRED
+            else:
+                self.log_error(f"Failed to enable module {module_name}:{target_stream}")
+                return Result.NOT_KEPT
+
+        return self._run_transaction(base, verify)
 
     def _disable_module(self, mpc, base, module_name):
         """Disable a module stream so it cannot be enabled by dependency resolution."""
         mpc.disable(module_name)
-        mpc.save()
-        base.resolve()
-        base.do_transaction()
-        if mpc.isDisabled(module_name):
-            self.log_info(f"Module {module_name} disabled successfully")
-            return Result.REPAIRED
-        else:
-            self.log_error(f"Failed to disable module {module_name}")
-            return Result.NOT_KEPT
+        self._save_module_state(mpc)
+
+        def verify():
+            if mpc.isDisabled(module_name):
+                self.log_info(f"Module {module_name} disabled successfully")
+                return Result.REPAIRED
+            else:
+                self.log_error(f"Failed to disable module {module_name}")
+                return Result.NOT_KEPT
+
+        return self._run_transaction(base, verify)
 
     def _get_profile_packages(self, mpc, module_name, stream, profile_name):
         # mpc.query(name) returns a vector of ModulePackage objects
@@ -435,47 +903,42 @@ class AppStreamsPromiseTypeModule(PromiseModule):
             self.log_error(f"Failed to switch module {module_spec}: {e}")
             return Result.NOT_KEPT
 
-        # Resolve and execute transaction
-        base.resolve()
-
-        # Download packages before transaction (following DNF CLI pattern)
-        pkgs_to_download = list(base.transaction.install_set)
-        if pkgs_to_download:
-            base.download_packages(pkgs_to_download)
-
-        base.do_transaction()
+        def verify():
+            # Verify switch succeeded
+            try:
+                enabled_stream = mpc.getEnabledStream(module_name)
+            except RuntimeError:
+                self.log_error(
+                    f"Failed to get enabled stream for {module_name} after switch"
+                )
+                return Result.NOT_KEPT
 
-        # Verify switch succeeded
-        try:
-            enabled_stream = mpc.getEnabledStream(module_name)
-        except RuntimeError:
-            self.log_error(
-                f"Failed to get enabled stream for {module_name} after switch"
-            )
-            return Result.NOT_KEPT
+            if enabled_stream != stream:
+                self.log_error(
+                    f"Module {module_name} stream is {enabled_stream}, expected {stream}"
+                )
+                return Result.NOT_KEPT
 
-        if enabled_stream != stream:
-            self.log_error(
-                f"Module {module_name} stream is {enabled_stream}, expected {stream}"
-            )
-            return Result.NOT_KEPT
+            try:
+                installed_profiles = mpc.getInstalledProfiles(module_name)
+            except RuntimeError:
+                self.log_error(
+                    f"Failed to get installed profiles for {module_name} after switch"
+                )
+                return Result.NOT_KEPT
 
-        try:
-            installed_profiles = mpc.getInstalledProfiles(module_name)
-        except RuntimeError:
-            self.log_error(
-                f"Failed to get installed profiles for {module_name} after switch"
-            )
-            return Result.NOT_KEPT
+            if profile not in installed_profiles:
+                self.log_error(
+                    f"Profile {profile} not in installed profiles {installed_profiles}"
+                )
+                return Result.NOT_KEPT
 
-        if profile not in installed_profiles:
-            self.log_error(
-                f"Profile {profile} not in installed profiles {installed_profiles}"
+            self.log_info(
+                f"Module {module_name}:{stream}/{profile} switched successfully"
             )
-            return Result.NOT_KEPT
+            return Result.REPAIRED
 
-        self.log_info(f"Module {module_name}:{stream}/{profile} switched successfully")
-        return Result.REPAIRED
+        return self._run_transaction(base, verify, download=True)
 
     def _install_module(self, mpc, base, module_name, stream, profile, options=None):
         """Enable a module stream and install the given (or default) profile's packages."""
@@ -520,33 +983,27 @@ class AppStreamsPromiseTypeModule(PromiseModule):
             self.log_error(f"Failed to install module {spec}: {e}")
             return Result.NOT_KEPT
 
-        base.resolve()
-
-        # Explicitly download packages before the transaction. Without this,
-        # do_transaction() uses paths resolved during fill_sack(), which may
-        # point to stale entries from a previously interrupted transaction that
-        # no longer exist on disk, causing a FileNotFoundError.
-        pkgs_to_download = list(base.transaction.install_set)
-        if pkgs_to_download:
-            base.download_packages(pkgs_to_download)
-
-        base.do_transaction()
+        def verify():
+            # Verify using the module database only — not the RPM sack, which was
+            # populated before the transaction and cannot see newly installed
+            # packages.
+            try:
+                profile_installed = profile in mpc.getInstalledProfiles(module_name)
+            except RuntimeError:
+                profile_installed = False
 
-        # Verify using the module database only — not the RPM sack, which was
-        # populated before the transaction and cannot see newly installed packages.
-        try:
-            profile_installed = profile in mpc.getInstalledProfiles(module_name)
-        except RuntimeError:
-            profile_installed = False
+            if profile_installed:
+                self.log_info(
+                    f"Module {module_name}:{stream}/{profile} installed successfully"
+                )
+                return Result.REPAIRED
+            else:
+                self.log_error(
+                    f"Failed to install module {module_name}:{stream}/{profile}"
+                )
+                return Result.NOT_KEPT
 
-        if profile_installed:
-            self.log_info(
-                f"Module {module_name}:{stream}/{profile} installed successfully"
-            )
-            return Result.REPAIRED
-        else:
-            self.log_error(f"Failed to install module {module_name}:{stream}/{profile}")
-            return Result.NOT_KEPT
+        return self._run_transaction(base, verify, download=True)
 
     def _remove_module(self, mpc, base, module_name, stream, profile):
         """Uninstall profile packages and leave the stream in enabled (pinned) state."""
@@ -575,21 +1032,22 @@ class AppStreamsPromiseTypeModule(PromiseModule):
                     self.log_verbose(f"Failed to remove package {pkg}: {e}")
                     failed_packages.append((pkg, str(e)))
 
-        mpc.save()
-        base.resolve(allow_erasing=True)
-        base.do_transaction()
+        self._save_module_state(mpc)
+
+        def verify():
+            # Verify removal succeeded. After uninstalling a profile, DNF leaves
+            # the stream in "enabled" state (stream pinned, no packages
+            # installed). "removed" only occurs when the module is fully reset.
+            # Accept any state other than "installed" as success.
+            if self._get_module_state(mpc, module_name) != "installed":
+                self.log_info(f"Module {module_name} removed successfully")
+                return Result.REPAIRED
+            else:
+                self.log_error(f"Failed to remove module {module_name}")
+                self._log_failed_packages(failed_packages)
+                return Result.NOT_KEPT
 
-        # Verify removal succeeded. After uninstalling a profile, DNF leaves
-        # the stream in "enabled" state (stream pinned, no packages installed).
-        # "removed" only occurs when the module is fully reset. Accept any
-        # state other than "installed" as success.
-        if self._get_module_state(mpc, module_name) != "installed":
-            self.log_info(f"Module {module_name} removed successfully")
-            return Result.REPAIRED
-        else:
-            self.log_error(f"Failed to remove module {module_name}")
-            self._log_failed_packages(failed_packages)
-            return Result.NOT_KEPT
+        return self._run_transaction(base, verify, allow_erasing=True)
 
     def _reset_module(self, mpc, base, module_name):
         """Reset a module to factory state — no stream pinned, no enabled/disabled flag."""
@@ -600,15 +1058,16 @@ class AppStreamsPromiseTypeModule(PromiseModule):
             return Result.KEPT
 
         mpc.reset(module_name)
-        mpc.save()
-        base.resolve()
-        base.do_transaction()
+        self._save_module_state(mpc)
+
+        def verify():
+            # The in-memory mpc is not refreshed after do_transaction(), so
+            # getModuleState() still reflects the pre-reset state. Trust the
+            # operation — if no exception was raised the reset succeeded.
+            self.log_info(f"Module {module_name} reset successfully")
+            return Result.REPAIRED
 
-        # The in-memory mpc is not refreshed after do_transaction(), so
-        # getModuleState() still reflects the pre-reset state. Trust the
-        # operation — if no exception was raised the reset succeeded.
-        self.log_info(f"Module {module_name} reset successfully")
-        return Result.REPAIRED
+        return self._run_transaction(base, verify)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,7 @@
+import json
 import sys
+import time
+from types import SimpleNamespace
 import os
 import pytest
 from unittest.mock import MagicMock
@@ -28,6 +31,17 @@ from appstreams import AppStreamsPromiseTypeModule  # noqa: E402
 from cfengine_module_library import ValidationError, Result  # noqa: E402
 
 
+@pytest.fixture(autouse=True)
+def state_paths(tmp_path, monkeypatch):
+    # Keep tests away from the host's module and state files, and off the
+    # sack-free fast path unless a test sets MODULES_DIR up itself
+    monkeypatch.setattr(appstreams_module, "MODULES_DIR", str(tmp_path / "modules.d"))
+    monkeypatch.setattr(appstreams_module, "DNF_CACHE_DIR", str(tmp_path / "dnf"))
+    monkeypatch.setattr(
+        appstreams_module, "STATE_FILE", str(tmp_path / "appstreams_state.json")
+    )
+
+
 @pytest.fixture
 def module():
     # Reset mocks
@@ -319,3 +333,543 @@ def test_remove_unknown_module_runtime_error(module, mock_base, mock_mpc):
     result = module.evaluate_promise("unknown_mod", {"state": "removed"}, {})
     # With no stream and getEnabledStream failing, target_stream is None, so KEPT
     assert result == Result.KEPT
+
+
+def test_base_reused_across_kept_promises(module, mock_base, mock_mpc):
+    """Test that KEPT promises share one DNF Base and sack"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "12"
+
+    assert module.evaluate_promise("nodejs", {"state": "enabled"}, {}) == Result.KEPT
+    assert module.evaluate_promise("php", {"state": "enabled"}, {}) == Result.KEPT
+
+    assert mock_dnf.Base.call_count == 1
+    mock_base.fill_sack.assert_called_once()
+    mock_base.close.assert_not_called()
+
+    module.protocol_terminate()
+    mock_base.close.assert_called_once()
+
+
+def test_base_recreated_after_transaction(module, mock_base, mock_mpc):
+    """Test that a new Base is loaded after a promise changed the system"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = True
+
+    result = module.evaluate_promise("nodejs", {"state": "enabled", "stream": "12"}, {})
+    assert result == Result.REPAIRED
+    mock_base.close.assert_called_once()
+
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    assert module.evaluate_promise("php", {"state": "disabled"}, {}) == Result.KEPT
+    assert mock_dnf.Base.call_count == 2
+
+
+def test_base_comment_set_per_promise(module, mock_base, mock_mpc):
+    """Test that the DNF history comment reflects the promise being evaluated"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+
+    module.evaluate_promise("nodejs", {"state": "disabled", "handle": "h1"}, {})
+    assert mock_base.conf.comment == (
+        "CFEngine appstreams promise: nodejs state=disabled | handle: h1"
+    )
+    module.evaluate_promise("php", {"state": "disabled"}, {})
+    assert mock_base.conf.comment == "CFEngine appstreams promise: php state=disabled"
+
+
+@pytest.fixture
+def metadata_state(tmp_path):
+    return tmp_path / "appstreams_state.json"
+
+
+@pytest.fixture
+def mock_repo(mock_base):
+    repo = MagicMock()
+    repo.id = "appstream"
+    mock_base.repos.iter_enabled.side_effect = lambda: iter([repo])
+    yield repo
+    mock_base.repos.iter_enabled.side_effect = None
+
+
+def test_metadata_refreshed_when_older_than_max_age(
+    module, mock_base, mock_mpc, mock_repo, metadata_state
+):
+    """Test that expired metadata is refreshed and the refresh recorded"""
+    metadata_state.write_text(
+        json.dumps({"metadata_refreshed": {"appstream": time.time() - 7200}})
+    )
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+
+    module.evaluate_promise(
+        "nodejs", {"state": "disabled", "metadata_max_age": 3600}, {}
+    )
+
+    assert mock_repo.metadata_expire == 0
+    assert (
+        json.loads(metadata_state.read_text())["metadata_refreshed"]["appstream"]
+        > time.time() - 60
+    )
+
+
+def test_metadata_cached_within_max_age(
+    module, mock_base, mock_mpc, mock_repo, metadata_state
+):
+    """Test that metadata younger than metadata_max_age is not re-downloaded"""
+    refreshed_at = time.time() - 60
+    metadata_state.write_text(
+        json.dumps({"metadata_refreshed": {"appstream": refreshed_at}})
+    )
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+
+    module.evaluate_promise(
+        "nodejs", {"state": "disabled", "metadata_max_age": 3600}, {}
+    )
+
+    assert mock_repo.metadata_expire == -1
+    assert (
+        json.loads(metadata_state.read_text())["metadata_refreshed"]["appstream"]
+        == refreshed_at
+    )
+
+
+def test_download_error_retried_with_refreshed_metadata(
+    module, mock_base, mock_mpc, mock_repo, metadata_state, monkeypatch
+):
+    """Test that failed downloads with cached metadata are retried once"""
+
+    class DownloadError(Exception):
+        pass
+
+    monkeypatch.setattr(mock_dnf.exceptions, "DownloadError", DownloadError)
+    metadata_state.write_text(
+        json.dumps({"metadata_refreshed": {"appstream": time.time()}})
+    )
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "12"
+    mock_mpc.getInstalledProfiles.side_effect = [[], [], ["common"]]
+    mock_base.download_packages.side_effect = [DownloadError("404"), None]
+    mock_base.transaction.install_set = [make_rpm("pkg1", cached=False)]
+
+    result = module.evaluate_promise(
+        "nodejs",
+        {
+            "state": "installed",
+            "stream": "12",
+            "profile": "common",
+            "metadata_max_age": 3600,
+        },
+        {},
+    )
+
+    assert result == Result.REPAIRED
+    assert mock_dnf.Base.call_count == 2
+    assert mock_repo.metadata_expire == 0
+    mock_base.download_packages.side_effect = None
+
+
+@pytest.fixture
+def modules_dir(tmp_path):
+    path = tmp_path / "modules.d"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def mock_rpm(monkeypatch):
+    rpm = MagicMock()
+    monkeypatch.setitem(sys.modules, "rpm", rpm)
+    return rpm
+
+
+def make_rpm(name, cached, size=1000):
+    return SimpleNamespace(name=name, downloadsize=size, verifyLocalPkg=lambda: cached)
+
+
+def make_packages(names):
+    return [SimpleNamespace(name=name) for name in names]
+
+
+def write_module_file(modules_dir, name, state, stream="", profiles=""):
+    (modules_dir / f"{name}.module").write_text(
+        f"[{name}]\nname={name}\nstream={stream}\nprofiles={profiles}\n"
+        f"state={state}\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "state,file_state,stream",
+    [
+        ("enabled", "enabled", "12"),
+        ("disabled", "disabled", ""),
+        ("default", "", ""),
+        ("removed", "disabled", ""),
+    ],
+)
+def test_kept_from_module_file(module, modules_dir, state, file_state, stream):
+    """Test that KEPT is decided from modules.d without loading a sack"""
+    write_module_file(modules_dir, "nodejs", file_state, stream)
+
+    result = module.evaluate_promise("nodejs", {"state": state, "stream": "12"}, {})
+
+    assert result == Result.KEPT
+    mock_dnf.Base.assert_not_called()
+
+
+def test_module_file_mismatch_uses_sack(module, modules_dir, mock_base, mock_mpc):
+    """Test that the full check runs when the module file suggests a change"""
+    write_module_file(modules_dir, "nodejs", "enabled", "10")
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "10"
+    mock_mpc.isEnabled.return_value = True
+
+    result = module.evaluate_promise("nodejs", {"state": "enabled", "stream": "12"}, {})
+
+    assert result == Result.REPAIRED
+    mock_dnf.Base.assert_called_once()
+
+
+def test_installed_kept_from_rpmdb(module, modules_dir, mock_base, mock_mpc, mock_rpm):
+    """Test that an installed profile recorded by a full check is then KEPT
+    from modules.d and the RPM database alone"""
+    write_module_file(modules_dir, "nodejs", "enabled", "12", "common")
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "12"
+    mock_mpc.getInstalledProfiles.return_value = ["common"]
+    mock_profile = MagicMock()
+    mock_profile.getName.return_value = "common"
+    mock_profile.getContent.return_value = ["nodejs", "npm"]
+    mock_module = MagicMock()
+    mock_module.getStream.return_value = "12"
+    mock_module.getProfiles.return_value = [mock_profile]
+    mock_mpc.query.return_value = [mock_module]
+    mock_base.sack.query.return_value.installed.return_value = make_packages(
+        ["nodejs", "npm"]
+    )
+    mock_base.sack.query.return_value.upgrades.return_value = []
+    mock_rpm.TransactionSet.return_value.dbMatch.side_effect = lambda tag, name: [
+        {"modularitylabel": "nodejs:12:8030020201124152102:229f0a1c"}
+    ]
+    attributes = {"state": "installed", "stream": "12", "profile": "common"}
+
+    # No recorded profile packages yet: full check against the sack
+    assert module.evaluate_promise("nodejs", attributes, {}) == Result.KEPT
+    assert mock_dnf.Base.call_count == 1
+
+    module.protocol_terminate()
+    mock_dnf.Base.reset_mock()
+    assert module.evaluate_promise("nodejs", attributes, {}) == Result.KEPT
+    mock_dnf.Base.assert_not_called()
+
+    # A package left over from another stream needs the full check
+    mock_rpm.TransactionSet.return_value.dbMatch.side_effect = lambda tag, name: [
+        {"modularitylabel": "nodejs:10:8030020201124152102:229f0a1c"}
+    ]
+    module.evaluate_promise("nodejs", attributes, {})
+    mock_dnf.Base.assert_called_once()
+
+
+def write_repomd(tmp_path, repo, content):
+    path = tmp_path / "dnf" / repo / "repodata"
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "repomd.xml").write_text(content)
+
+
+@pytest.mark.parametrize(
+    "change",
+    ["metadata_refreshed", "package_updated", "old_state_format"],
+)
+def test_installed_needs_full_check_after_change(
+    module, modules_dir, mock_base, mock_mpc, mock_rpm, tmp_path, change
+):
+    """Test that a newer module version is looked for in the sack when the
+    metadata or the installed packages changed since the last full check"""
+    write_module_file(modules_dir, "nodejs", "enabled", "12", "common")
+    write_repomd(tmp_path, "appstream-1234", "<repomd/>")
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "12"
+    mock_mpc.getInstalledProfiles.return_value = ["common"]
+    mock_profile = MagicMock()
+    mock_profile.getName.return_value = "common"
+    mock_profile.getContent.return_value = ["nodejs", "npm"]
+    mock_module = MagicMock()
+    mock_module.getStream.return_value = "12"
+    mock_module.getProfiles.return_value = [mock_profile]
+    mock_mpc.query.return_value = [mock_module]
+    mock_base.sack.query.return_value.installed.return_value = make_packages(
+        ["nodejs", "npm"]
+    )
+    mock_base.sack.query.return_value.upgrades.return_value = []
+    mock_rpm.TransactionSet.return_value.dbMatch.side_effect = lambda tag, name: [
+        {"modularitylabel": b"nodejs:12:8030020201124152102:229f0a1c"}
+    ]
+    attributes = {"state": "installed", "stream": "12", "profile": "common"}
+    assert module.evaluate_promise("nodejs", attributes, {}) == Result.KEPT
+    module.protocol_terminate()
+    mock_dnf.Base.reset_mock()
+    assert module.evaluate_promise("nodejs", attributes, {}) == Result.KEPT
+    mock_dnf.Base.assert_not_called()
+
+    if change == "metadata_refreshed":
+        # which may bring a newer version of the stream
+        write_repomd(tmp_path, "appstream-1234", "<repomd>newer</repomd>")
+    elif change == "package_updated":
+        # from another version of the stream, outside of the promise
+        mock_rpm.TransactionSet.return_value.dbMatch.side_effect = lambda t, n: [
+            {"modularitylabel": b"nodejs:12:8030020201201000000:229f0a1c"}
+        ]
+    else:
+        module._get_state("profile_packages")["nodejs:12/common"] = ["nodejs", "npm"]
+
+    assert module.evaluate_promise("nodejs", attributes, {}) == Result.KEPT
+    mock_dnf.Base.assert_called_once()
+    # recorded again by the full check
+    module.protocol_terminate()
+    mock_dnf.Base.reset_mock()
+    assert module.evaluate_promise("nodejs", attributes, {}) == Result.KEPT
+    mock_dnf.Base.assert_not_called()
+
+
+def test_installed_upgrade_found_by_full_check(
+    module, modules_dir, mock_base, mock_mpc, mock_rpm, tmp_path
+):
+    """Test that a profile with an available upgrade isn't recorded, so it's
+    not KEPT from the RPM database either"""
+    write_module_file(modules_dir, "nodejs", "enabled", "12", "common")
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "12"
+    mock_mpc.getInstalledProfiles.return_value = ["common"]
+    mock_profile = MagicMock()
+    mock_profile.getName.return_value = "common"
+    mock_profile.getContent.return_value = ["nodejs", "npm"]
+    mock_module = MagicMock()
+    mock_module.getStream.return_value = "12"
+    mock_module.getProfiles.return_value = [mock_profile]
+    mock_mpc.query.return_value = [mock_module]
+    mock_base.sack.query.return_value.installed.return_value = make_packages(
+        ["nodejs", "npm"]
+    )
+    mock_base.sack.query.return_value.upgrades.return_value = make_packages(["npm"])
+    mock_rpm.TransactionSet.return_value.dbMatch.side_effect = lambda tag, name: [
+        {"modularitylabel": "nodejs:12:8030020201124152102:229f0a1c"}
+    ]
+    attributes = {"state": "installed", "stream": "12", "profile": "common"}
+
+    module.evaluate_promise("nodejs", attributes, {})
+    module.protocol_terminate()
+    assert module._get_state("profile_packages") == {}
+    mock_dnf.Base.reset_mock()
+    module.evaluate_promise("nodejs", attributes, {})
+    mock_dnf.Base.assert_called_once()
+
+
+def test_batched_promises_share_one_transaction(module, mock_base, mock_mpc):
+    """Test that batched promises are resolved and run in one transaction"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = True
+
+    for name, handle in (("nodejs", "h_nodejs"), ("php", "h_php")):
+        result = module.evaluate_promise(
+            name,
+            {"state": "enabled", "stream": "1", "batch": True, "handle": handle},
+            {},
+        )
+        # not applied yet, so not reported as repaired
+        assert result == Result.NOT_KEPT
+    mock_base.do_transaction.assert_not_called()
+    # the module state is only saved by the transaction
+    mock_mpc.save.assert_not_called()
+    assert mock_dnf.Base.call_count == 1
+
+    assert module.protocol_terminate() == Result.SUCCESS
+    mock_base.resolve.assert_called_once()
+    mock_base.do_transaction.assert_called_once()
+    assert "handle: h_nodejs" in mock_base.conf.comment
+    assert "handle: h_php" in mock_base.conf.comment
+    mock_base.close.assert_called_once()
+
+
+def test_batch_committed_before_unbatched_promise(module, mock_base, mock_mpc):
+    """Test that a promise outside of the batch sees the batch applied first"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = True
+
+    module.evaluate_promise(
+        "nodejs", {"state": "enabled", "stream": "12", "batch": True}, {}
+    )
+    mock_base.do_transaction.assert_not_called()
+
+    result = module.evaluate_promise("php", {"state": "disabled"}, {})
+    assert result == Result.KEPT
+    mock_base.do_transaction.assert_called_once()
+    assert module.protocol_terminate() == Result.SUCCESS
+
+
+def test_failed_batch_reported_on_terminate(module, mock_base, mock_mpc):
+    """Test that a failed batched transaction makes terminate fail"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = False
+
+    module.evaluate_promise(
+        "nodejs", {"state": "enabled", "stream": "12", "batch": True}, {}
+    )
+
+    assert module.protocol_terminate() == Result.FAILURE
+
+
+def test_failed_batch_flushed_mid_run_reported_on_terminate(
+    module, mock_base, mock_mpc
+):
+    """Test that a batched transaction failing when an unbatched promise
+    flushes it still makes terminate fail"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = False
+
+    module.evaluate_promise(
+        "nodejs", {"state": "enabled", "stream": "12", "batch": True}, {}
+    )
+    module.evaluate_promise("php", {"state": "disabled"}, {})
+    mock_base.do_transaction.assert_called_once()
+
+    assert module.protocol_terminate() == Result.FAILURE
+
+
+def test_batch_committed_before_promise_with_other_options(module, mock_base, mock_mpc):
+    """Test that the DNF options of one batched promise don't apply to
+    another one"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = True
+    attributes = {"state": "enabled", "stream": "12", "batch": True}
+
+    comments = []
+    mock_base.do_transaction.side_effect = lambda: comments.append(
+        mock_base.conf.comment
+    )
+
+    module.evaluate_promise("nodejs", attributes, {})
+    module.evaluate_promise("php", attributes, {})
+    module.evaluate_promise(
+        "ruby", dict(attributes, options=["install_weak_deps=False"]), {}
+    )
+    assert module.protocol_terminate() == Result.SUCCESS
+    mock_base.do_transaction.side_effect = None
+
+    assert len(comments) == 2
+    assert "nodejs" in comments[0] and "php" in comments[0]
+    assert "ruby" not in comments[0]
+    assert "ruby" in comments[1]
+
+
+def test_failed_promise_discards_pending_batch(
+    module, mock_base, mock_mpc, monkeypatch
+):
+    """Test that a batched promise failing halfway doesn't leave its changes
+    in the goal for the batch to apply"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = True
+    module.evaluate_promise(
+        "nodejs", {"state": "enabled", "stream": "12", "batch": True}, {}
+    )
+
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "12"
+    mock_mpc.getInstalledProfiles.return_value = []
+    monkeypatch.setattr(mock_dnf.exceptions, "Error", RuntimeError)
+    module_base = mock_dnf.module.module_base.ModuleBase.return_value
+    monkeypatch.setattr(
+        module_base.install, "side_effect", RuntimeError("no such profile")
+    )
+    result = module.evaluate_promise(
+        "php",
+        {"state": "installed", "stream": "12", "profile": "common", "batch": True},
+        {},
+    )
+    assert result == Result.NOT_KEPT
+    mock_base.close.assert_called_once()
+
+    assert module.protocol_terminate() == Result.FAILURE
+    mock_base.do_transaction.assert_not_called()
+
+
+def test_libdnf_error_in_batch_reported_on_terminate(module, mock_base, mock_mpc):
+    """Test that a RuntimeError of libdnf during the batched transaction
+    neither crashes terminate nor fails an unrelated promise"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_DISABLED
+    mock_mpc.isEnabled.return_value = True
+    mock_base.do_transaction.side_effect = RuntimeError("rpmdb locked")
+    try:
+        module.evaluate_promise(
+            "nodejs", {"state": "enabled", "stream": "12", "batch": True}, {}
+        )
+        assert module.evaluate_promise("php", {"state": "disabled"}, {}) == (
+            Result.KEPT
+        )
+    finally:
+        mock_base.do_transaction.side_effect = None
+
+    assert module.protocol_terminate() == Result.FAILURE
+
+
+def test_installed_check_queries_large_sack_once(module, mock_base, mock_mpc):
+    """Test the installed-profile check against a sack with thousands of
+    packages: the sack is queried once per session, not once per package"""
+    installed_names = [f"pkg{i}" for i in range(20000)]
+    profile_packages = installed_names[:2000]
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "1"
+    mock_mpc.getInstalledProfiles.return_value = ["server"]
+    mock_profile = MagicMock()
+    mock_profile.getName.return_value = "server"
+    mock_profile.getContent.return_value = profile_packages
+    mock_module = MagicMock()
+    mock_module.getStream.return_value = "1"
+    mock_module.getProfiles.return_value = [mock_profile]
+    mock_mpc.query.return_value = [mock_module]
+    query = mock_base.sack.query.return_value
+    query.installed.return_value = make_packages(installed_names)
+    query.upgrades.return_value = make_packages(installed_names[-100:])
+    attributes = {"state": "installed", "stream": "1", "profile": "server"}
+
+    for _ in range(10):
+        assert module.evaluate_promise("postgresql", attributes, {}) == Result.KEPT
+
+    # the sack is loaded and queried for installed packages and upgrades once,
+    # the module metadata once per promise, and never per package
+    mock_base.fill_sack.assert_called_once()
+    assert mock_base.sack.query.call_count == 2
+    query.installed.assert_called_once()
+    query.upgrades.assert_called_once()
+    query.filter.assert_not_called()
+    assert mock_mpc.query.call_count == 10
+
+
+def test_install_downloads_only_uncached_packages(module, mock_base, mock_mpc):
+    """Test that cached RPMs are reused and parallel downloads are tuned"""
+    mock_mpc.getModuleState.return_value = mock_mpc.ModuleState_ENABLED
+    mock_mpc.getEnabledStream.return_value = "12"
+    mock_mpc.getInstalledProfiles.side_effect = [[], ["common"]]
+    cached = make_rpm("nodejs", cached=True)
+    remote = make_rpm("npm", cached=False, size=4096)
+    mock_base.transaction.install_set = [cached, remote]
+
+    result = module.evaluate_promise(
+        "nodejs",
+        {
+            "state": "installed",
+            "stream": "12",
+            "profile": "common",
+            "max_parallel_downloads": 10,
+        },
+        {},
+    )
+
+    assert result == Result.REPAIRED
+    mock_base.download_packages.assert_called_once_with([remote])
+    assert mock_base.conf.max_parallel_downloads == 10
+    mock_base.transaction.install_set = []
+
+
+@pytest.mark.parametrize("value", [0, 21])
+def test_max_parallel_downloads_validation_invalid(module, value):
+    """Test that max_parallel_downloads is limited to what DNF accepts"""
+    with pytest.raises(ValidationError):
+        module._validate_max_parallel_downloads(value)
@@ -1,8 +1,13 @@
+import hashlib
+import json
 import os
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from cfengine_module_library import (
     PromiseModule,
@@ -11,6 +16,17 @@ from cfengine_module_library import (
     AttributeObject,
 )
 
+STATE_FILE = "/var/cfengine/state/git_promise_state.json"
+MIRRORS_DIR = "/var/cfengine/state/git_mirrors"
+MAX_PARALLEL_FETCHES = 8
+
+
+def _sparse_paths(model: AttributeObject) -> List[str]:
+    # the directories as listed by git sparse-checkout list
+    return sorted(
+        set(path.strip("/") for path in model.sparse_paths if path.strip("/"))
+    )
+
 
 class GitPromiseTypeModule(PromiseModule):
     def __init__(self, **kwargs):
@@ -39,14 +55,33 @@ class GitPromiseTypeModule(PromiseModule):
             "depth", int, default=0, validator=depth_must_be_zero_or_more
         )
         self.add_attribute("executable", str, default="git")
+        self.add_attribute(
+            "fetch_interval", int, default=0, validator=depth_must_be_zero_or_more
+        )
+        self.add_attribute("filter", str)
         self.add_attribute("force", bool, default=False)
+        self.add_attribute("mirror", bool, default=False)
         self.add_attribute("recursive", bool, default=True)
         self.add_attribute("reference", str)
         self.add_attribute("remote", str, default="origin")
+        self.add_attribute("sparse_paths", list)
         self.add_attribute("ssh_executable", str, default="ssh")
         self.add_attribute("ssh_options", str)
         self.add_attribute("update", bool, default=True)
         self.add_attribute("version", str, default="HEAD")
+        self.add_attribute("worktree", bool, default=False)
+
+        # Environment of the git commands for each GIT_SSH_COMMAND
+        self._envs = {}
+        self._state = None
+        # Mirrors already cloned or fetched during this agent run
+        self._updated_mirrors = set()
+        self._mirror_locks = {}
+        self._state_lock = threading.Lock()
+        # Background fetches started at init, by destination
+        self._executor = None
+        self._prefetches = {}
+        self._background = threading.local()
 
     def evaluate_promise(self, promiser: str, attributes: Dict, metadata: Dict):
         safe_promiser = promiser.replace(",", "_")
@@ -71,27 +106,10 @@ class GitPromiseTypeModule(PromiseModule):
                         destination=model.destination,
                     )
                 )
-                clone_options = []
-                if model.bare:
-                    clone_options += ["--bare"]
-                if model.depth:
-                    clone_options += ["--depth={depth}".format(depth=model.depth)]
-                if model.reference:
-                    clone_options += ["--reference", model.reference]
-                self._git(
-                    model,
-                    [
-                        model.executable,
-                        "clone",
-                        model.repository,
-                        model.destination,
-                        "--origin",
-                        model.remote,
-                        "--branch",
-                        model.version,
-                    ]
-                    + clone_options,
-                )
+                if model.worktree:
+                    self._add_worktree(model)
+                else:
+                    self._clone(model)
                 classes.append(
                     "{safe_promiser}_cloned".format(safe_promiser=safe_promiser)
                 )
@@ -151,40 +169,77 @@ class GitPromiseTypeModule(PromiseModule):
                         ],
                     )
 
-            # Update the repository
-            if model.update:
+            # Keep the sparse checkout in sync with the promised paths
+            if model.sparse_paths is not None and not model.bare and not model.worktree:
                 try:
-                    self.log_verbose(
-                        "Fetch '{repository}' in '{destination}'".format(
-                            repository=model.repository, destination=model.destination
+                    if self._sync_sparse_paths(model):
+                        classes.append(
+                            "{safe_promiser}_sparse_paths_changed".format(
+                                safe_promiser=safe_promiser
+                            )
                         )
+                        result = Result.REPAIRED
+                except subprocess.CalledProcessError as e:
+                    self.log_error(
+                        "Failed sparse checkout: {error}".format(error=e.output or e)
                     )
-                    # fetch the remote
-                    self._git(
-                        model,
-                        [model.executable, "fetch", model.remote],
-                        cwd=model.destination,
+                    if e.stderr:
+                        self.log_error(e.stderr.strip())
+                    return (
+                        Result.NOT_KEPT,
+                        [
+                            "{safe_promiser}_sparse_checkout_failed".format(
+                                safe_promiser=safe_promiser
+                            )
+                        ],
                     )
-                    # checkout the branch, if different from the current one
-                    output = self._git(
-                        model,
+
+            # Move the worktree to the promised version
+            if model.update and model.worktree:
+                try:
+                    if self._update_worktree(model):
+                        result = Result.REPAIRED
+                    classes.append(
+                        "{safe_promiser}_updated".format(safe_promiser=safe_promiser)
+                    )
+                except subprocess.CalledProcessError as e:
+                    self.log_error("Failed update: {error}".format(error=e.output or e))
+                    if e.stderr:
+                        self.log_error(e.stderr.strip())
+                    return (
+                        Result.NOT_KEPT,
                         [
-                            model.executable,
-                            "rev-parse",
-                            "--abbrev-ref",
-                            "HEAD".format(),
+                            "{safe_promiser}_update_failed".format(
+                                safe_promiser=safe_promiser
+                            )
                         ],
-                        cwd=model.destination,
                     )
-                    detached = False
-                    if output == "HEAD":
-                        detached = True
-                        output = self._git(
-                            model,
-                            [model.executable, "rev-parse", "HEAD"],
-                            cwd=model.destination,
+
+            # Update the repository
+            elif model.update:
+                try:
+                    head_commit, head_ref, refs = self._get_fetched_refs(
+                        model, attributes
+                    )
+                    local_commit = refs.get("refs/heads/" + model.version)
+                    remote_commit = refs.get(
+                        "refs/remotes/{remote}/{version}".format(
+                            remote=model.remote, version=model.version
                         )
-                    if output != model.version:
+                    )
+                    # checkout the version, if different from the current one
+                    if model.version == "HEAD":
+                        checkout = False
+                    elif local_commit or remote_commit:
+                        checkout = head_ref != "refs/heads/" + model.version
+                    elif "refs/tags/" + model.version in refs:
+                        checkout = head_commit != refs["refs/tags/" + model.version]
+                    else:
+                        # a commit id, or any other revision
+                        checkout = not head_commit.startswith(
+                            model.version
+                        ) and head_commit != self._get_commit(model, model.version)
+                    if checkout:
                         self.log_info(
                             "Checkout '{repository}:{version}' in '{destination}'".format(
                                 repository=model.repository,
@@ -198,38 +253,35 @@ class GitPromiseTypeModule(PromiseModule):
                             cwd=model.destination,
                         )
                         result = Result.REPAIRED
+                        if local_commit or remote_commit:
+                            head_ref = "refs/heads/" + model.version
+                            head_commit = local_commit or remote_commit
+                        else:
+                            head_ref = "HEAD"
                     # check if merge with the remote branch is needed
-                    if not detached:
-                        output = self._git(
+                    if (
+                        head_ref != "HEAD"
+                        and remote_commit
+                        and remote_commit != head_commit
+                        and not self._is_ancestor(model, remote_commit, head_commit)
+                    ):
+                        self.log_info(
+                            "Merge '{remote}/{version}' in '{destination}'".format(
+                                remote=model.remote,
+                                version=model.version,
+                                destination=model.destination,
+                            )
+                        )
+                        self._git(
                             model,
                             [
                                 model.executable,
-                                "diff",
-                                "--shortstat",
-                                "..{remote}/{version}".format(
-                                    remote=model.remote, version=model.version
-                                ),
+                                "merge",
+                                model.remote + "/" + model.version,
                             ],
                             cwd=model.destination,
                         )
-                        if output != "":
-                            self.log_info(
-                                "Merge '{remote}/{version}' in '{destination}'".format(
-                                    remote=model.remote,
-                                    version=model.version,
-                                    destination=model.destination,
-                                )
-                            )
-                            self._git(
-                                model,
-                                [
-                                    model.executable,
-                                    "merge",
-                                    model.remote + "/" + model.version,
-                                ],
-                                cwd=model.destination,
-                            )
-                            result = Result.REPAIRED
+                        result = Result.REPAIRED
                     classes.append(
                         "{safe_promiser}_updated".format(safe_promiser=safe_promiser)
                     )
@@ -249,6 +301,452 @@ class GitPromiseTypeModule(PromiseModule):
         # everything okay
         return (result, classes)
 
+    def _update_refs(self, model: AttributeObject) -> Tuple[str, str, Dict[str, str]]:
+        """Fetch the remote if the promised version moved there, and return
+        the refs as _get_refs does."""
+        head_commit, head_ref, refs = self._get_refs(model)
+        if not self._is_fetch_needed(model, head_commit, refs):
+            return (head_commit, head_ref, refs)
+        self.log_verbose(
+            "Fetch '{repository}' in '{destination}'".format(
+                repository=model.repository, destination=model.destination
+            )
+        )
+        if model.mirror:
+            # fetch the remote refs from the mirror
+            self._git(
+                model,
+                [
+                    model.executable,
+                    "fetch",
+                    self._get_mirror(model),
+                    "+refs/heads/*:refs/remotes/{remote}/*".format(remote=model.remote),
+                    "+refs/tags/*:refs/tags/*",
+                ],
+                cwd=model.destination,
+            )
+        else:
+            # fetch the remote
+            self._git(
+                model,
+                [model.executable, "fetch", model.remote],
+                cwd=model.destination,
+            )
+        self._remember_remote_check(model)
+        return self._get_refs(model)
+
+    def _get_fetched_refs(
+        self, model: AttributeObject, attributes: Dict
+    ) -> Tuple[str, str, Dict[str, str]]:
+        """Return the refs of the repository once it is fetched, waiting for
+        its background fetch if one was started for the same promise. The
+        refs are read again afterwards, the checkout may have changed since
+        the fetch."""
+        prefetch = self._prefetches.pop(model.destination, None)
+        error = None
+        if prefetch is not None:
+            # wait for it even if it can't be used, it runs git in the
+            # repository too
+            messages, error = prefetch.result()
+            for level, message in messages:
+                self._log(level, message)
+        repositories = self._get_state("repositories")
+        if repositories.get(model.destination) != attributes:
+            # remember the repository to fetch it in the background during
+            # the next agent runs
+            with self._state_lock:
+                repositories[model.destination] = attributes
+                self._save_state()
+            # the background fetch used the attributes of the last agent run
+            prefetch = None
+        if prefetch is None:
+            return self._update_refs(model)
+
+        if error is not None:
+            raise error
+        return self._get_refs(model)
+
+    def _prefetch(self, model: AttributeObject):
+        self._background.messages = messages = []
+        try:
+            self._update_refs(model)
+            return (messages, None)
+        except subprocess.CalledProcessError as e:
+            return (messages, e)
+        finally:
+            self._background.messages = None
+
+    def protocol_init(self, version):
+        """Start fetching the repositories updated during the previous agent
+        runs in the background, so the promises only wait for their own."""
+        repositories = self._get_state("repositories")
+        for destination, attributes in list(repositories.items()):
+            if not os.path.exists(destination):
+                del repositories[destination]
+                continue
+            try:
+                model = self.create_attribute_object(destination, attributes)
+            except ValidationError:
+                del repositories[destination]
+                continue
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_FETCHES)
+            self._prefetches[destination] = self._executor.submit(self._prefetch, model)
+        return Result.SUCCESS
+
+    def protocol_terminate(self):
+        if self._executor is not None:
+            for prefetch in self._prefetches.values():
+                prefetch.cancel()
+            self._executor.shutdown(wait=True)
+        if self._prefetches:
+            # forget the repositories which are no longer promised
+            repositories = self._get_state("repositories")
+            for destination in self._prefetches:
+                repositories.pop(destination, None)
+            self._save_state()
+        return Result.SUCCESS
+
+    def _log(self, level, message):
+        messages = getattr(self._background, "messages", None)
+        if messages is not None:
+            # logged when the promise of the background fetch is evaluated
+            messages.append((level, message))
+        else:
+            super(GitPromiseTypeModule, self)._log(level, message)
+
+    def _clone(self, model: AttributeObject):
+        source = model.repository
+        clone_options = []
+        if model.bare:
+            clone_options += ["--bare"]
+        if model.mirror:
+            # borrow the objects of the mirror through alternates
+            # instead of downloading them again
+            source = self._get_mirror(model)
+            clone_options += ["--shared"]
+        else:
+            if model.depth:
+                clone_options += ["--depth={depth}".format(depth=model.depth)]
+            if model.filter:
+                clone_options += ["--filter={filter}".format(filter=model.filter)]
+        if model.reference:
+            clone_options += ["--reference", model.reference]
+        if model.sparse_paths is not None and not model.bare:
+            # only check out the files at the root until the
+            # sparse paths are set
+            clone_options += ["--sparse"]
+        self._git(
+            model,
+            [
+                model.executable,
+                "clone",
+                source,
+                model.destination,
+                "--origin",
+                model.remote,
+                "--branch",
+                model.version,
+            ]
+            + clone_options,
+        )
+        if model.mirror:
+            self._git(
+                model,
+                [
+                    model.executable,
+                    "remote",
+                    "set-url",
+                    model.remote,
+                    model.repository,
+                ],
+                cwd=model.destination,
+            )
+        if model.sparse_paths and not model.bare:
+            self._git(
+                model,
+                [model.executable, "sparse-checkout", "set", "--cone"]
+                + _sparse_paths(model),
+                cwd=model.destination,
+            )
+
+    def _add_worktree(self, model: AttributeObject):
+        """Add the destination as a worktree of the mirror of the repository,
+        detached at the promised version."""
+        mirror = self._get_mirror(model)
+        # forget the worktrees whose directory was removed
+        self._git(model, [model.executable, "worktree", "prune"], cwd=mirror)
+        self._git(
+            model,
+            [
+                model.executable,
+                "worktree",
+                "add",
+                "--detach",
+                model.destination,
+                model.version,
+            ],
+            cwd=mirror,
+        )
+
+    def _update_worktree(self, model: AttributeObject) -> bool:
+        """Move the worktree to the commit of the promised version in the
+        mirror, returning whether it moved."""
+        if not self._was_checked_recently(model):
+            self._get_mirror(model)
+            self._remember_remote_check(model)
+        # the worktree shares the refs of the mirror
+        head_commit, commit = self._git(
+            model,
+            [model.executable, "rev-parse", "HEAD", model.version + "^{commit}"],
+            cwd=model.destination,
+        ).splitlines()
+        if head_commit == commit:
+            return False
+        self.log_info(
+            "Checkout '{repository}:{version}' in '{destination}'".format(
+                repository=model.repository,
+                version=model.version,
+                destination=model.destination,
+            )
+        )
+        self._git(
+            model,
+            [model.executable, "checkout", "--detach", commit],
+            cwd=model.destination,
+        )
+        return True
+
+    def _sync_sparse_paths(self, model: AttributeObject) -> bool:
+        """Set the cone-mode sparse checkout to the promised paths, or turn it
+        off if there are none, returning whether it changed."""
+        try:
+            current = self._git(
+                model,
+                [model.executable, "sparse-checkout", "list"],
+                cwd=model.destination,
+            ).splitlines()
+        except subprocess.CalledProcessError:
+            # this worktree is not sparse
+            current = None
+        paths = _sparse_paths(model)
+        if not paths:
+            if current is None:
+                return False
+            self.log_info(
+                "Disable sparse checkout in '{destination}'".format(
+                    destination=model.destination
+                )
+            )
+            self._git(
+                model,
+                [model.executable, "sparse-checkout", "disable"],
+                cwd=model.destination,
+            )
+            return True
+        if current is not None and sorted(current) == paths:
+            return False
+        self.log_info(
+            "Set sparse checkout paths of '{destination}' to '{paths}'".format(
+                destination=model.destination, paths="', '".join(paths)
+            )
+        )
+        self._git(
+            model,
+            [model.executable, "sparse-checkout", "set", "--cone"] + paths,
+            cwd=model.destination,
+        )
+        return True
+
+    def _get_refs(self, model: AttributeObject) -> Tuple[str, str, Dict[str, str]]:
+        """Return the commit and the full ref name of HEAD ("HEAD" when
+        detached), and the commits of the local branch, remote branch and tag
+        named after the promised version, from two plumbing commands."""
+        head = self._git(
+            model,
+            [model.executable, "rev-parse", "HEAD", "--symbolic-full-name", "HEAD"],
+            cwd=model.destination,
+        ).splitlines()
+        output = self._git(
+            model,
+            [
+                model.executable,
+                "for-each-ref",
+                # the peeled commit of annotated tags, the commit otherwise
+                "--format=%(refname) %(objectname) %(*objectname)",
+                "refs/heads/" + model.version,
+                "refs/remotes/{remote}/{version}".format(
+                    remote=model.remote, version=model.version
+                ),
+                "refs/tags/" + model.version,
+            ],
+            cwd=model.destination,
+        )
+        refs = {}
+        for line in output.splitlines():
+            name, commit, peeled = (line.split(" ") + [""])[:3]
+            refs[name] = peeled or commit
+        return (head[0], head[-1], refs)
+
+    def _is_fetch_needed(
+        self, model: AttributeObject, head_commit: str, refs: Dict[str, str]
+    ) -> bool:
+        """Check whether the remote ref of the promised version moved, with
+        ls-remote of just that ref, at most once every fetch_interval
+        seconds."""
+        if self._was_checked_recently(model):
+            return False
+
+        tracking_ref = "refs/remotes/{remote}/{version}".format(
+            remote=model.remote, version=model.version
+        )
+        if model.version == "HEAD":
+            remote_refs = ["HEAD"]
+        elif tracking_ref in refs or "refs/heads/" + model.version in refs:
+            remote_refs = ["refs/heads/" + model.version]
+        elif "refs/tags/" + model.version in refs:
+            tracking_ref = "refs/tags/" + model.version
+            remote_refs = [tracking_ref, tracking_ref + "^{}"]
+        else:
+            # a commit id, or any other revision, only fetch it if unknown
+            if head_commit.startswith(model.version):
+                return False
+            try:
+                self._get_commit(model, model.version)
+                return False
+            except subprocess.CalledProcessError:
+                return True
+
+        output = self._git(
+            model,
+            [
+                model.executable,
+                "ls-remote",
+                self._get_mirror(model) if model.mirror else model.remote,
+            ]
+            + remote_refs,
+            cwd=model.destination,
+        )
+        remote_commits = dict(
+            reversed(line.split("\t")) for line in output.splitlines()
+        )
+        # the peeled commit of annotated tags, the commit otherwise
+        remote_commit = remote_commits.get(remote_refs[-1]) or remote_commits.get(
+            remote_refs[0]
+        )
+        if remote_commit != refs.get(tracking_ref):
+            return True
+        self._remember_remote_check(model)
+        return False
+
+    def _was_checked_recently(self, model: AttributeObject) -> bool:
+        checked = self._get_state("remote_checked")
+        if time.time() - checked.get(model.destination, 0) < model.fetch_interval:
+            self.log_verbose(
+                "Remote of '{destination}' was checked less than {interval} seconds ago".format(
+                    destination=model.destination, interval=model.fetch_interval
+                )
+            )
+            return True
+        return False
+
+    def _remember_remote_check(self, model: AttributeObject):
+        if model.fetch_interval:
+            with self._state_lock:
+                self._get_state("remote_checked")[model.destination] = time.time()
+                self._save_state()
+
+    def _get_mirror(self, model: AttributeObject) -> str:
+        """Return the path of the mirror of the repository, cloning or
+        fetching it the first time it is needed during the agent run, so
+        all the checkouts of the repository share a single fetch."""
+        path = os.path.join(
+            MIRRORS_DIR,
+            hashlib.sha256(model.repository.encode("utf-8")).hexdigest()[:16] + ".git",
+        )
+        with self._mirror_locks.setdefault(path, threading.Lock()):
+            return self._update_mirror(model, path)
+
+    def _update_mirror(self, model: AttributeObject, path: str) -> str:
+        if path in self._updated_mirrors:
+            return path
+        if os.path.exists(path):
+            self.log_verbose(
+                "Fetch '{repository}' in mirror '{path}'".format(
+                    repository=model.repository, path=path
+                )
+            )
+            self._git(model, [model.executable, "fetch", "--prune"], cwd=path)
+        else:
+            self.log_verbose(
+                "Mirror '{repository}' to '{path}'".format(
+                    repository=model.repository, path=path
+                )
+            )
+            os.makedirs(MIRRORS_DIR, exist_ok=True)
+            # the checkouts borrow objects of the mirror which may no longer
+            # be referenced by it after a fetch --prune, so it must never
+            # remove unreachable objects
+            self._git(
+                model,
+                [
+                    model.executable,
+                    "clone",
+                    "--mirror",
+                    "--config",
+                    "gc.auto=0",
+                    "--config",
+                    "gc.pruneExpire=never",
+                    model.repository,
+                    path,
+                ],
+            )
+        self._updated_mirrors.add(path)
+        return path
+
+    def _get_state(self, section):
+        if self._state is None:
+            try:
+                with open(STATE_FILE) as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                self._state = {}
+            if not isinstance(self._state, dict):
+                self._state = {}
+        return self._state.setdefault(section, {})
+
+    def _save_state(self):
+        tmp_path = STATE_FILE + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self._state, f)
+            os.replace(tmp_path, STATE_FILE)
+        except OSError as e:
+            self.log_warning(
+                "Failed to save git promise state: {error}".format(error=e)
+            )
+
+    def _get_commit(self, model: AttributeObject, revision: str) -> str:
+        return self._git(
+            model,
+            [model.executable, "rev-parse", "--verify", revision + "^{commit}"],
+            cwd=model.destination,
+        )
+
+    def _is_ancestor(self, model: AttributeObject, commit: str, descendant: str):
+        try:
+            self._git(
+                model,
+                [model.executable, "merge-base", "--is-ancestor", commit, descendant],
+                cwd=model.destination,
+            )
+            return True
+        except subprocess.CalledProcessError as e:
+            if e.returncode == 1:
+                return False
+            raise
+
     def _git(
         self, model: AttributeObject, args: List[str], cwd: Optional[str] = None
     ) -> str:
@@ -268,13 +766,17 @@ class GitPromiseTypeModule(PromiseModule):
         return output
 
     def _git_envvars(self, model: AttributeObject):
-        env = os.environ.copy()
-        env["GIT_SSH_COMMAND"] = model.ssh_executable
+        ssh_command = model.ssh_executable
         if model.ssh_options:
-            env["GIT_SSH_COMMAND"] += " " + model.ssh_options
-        if "HOME" not in env:
-            # git should have a HOME env var to retrieve .gitconfig, .git-credentials, etc
-            env["HOME"] = str(Path.home())
+            ssh_command += " " + model.ssh_options
+        env = self._envs.get(ssh_command)
+        if env is None:
+            env = os.environ.copy()
+            env["GIT_SSH_COMMAND"] = ssh_command
+            if "HOME" not in env:
+                # git should have a HOME env var to retrieve .gitconfig, .git-credentials, etc
+                env["HOME"] = str(Path.home())
+            self._envs[ssh_command] = env
         return env
 
 
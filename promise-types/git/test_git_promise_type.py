@@ -0,0 +1,469 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../libraries/python"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cfengine_module_library import Result  # noqa: E402
+
+import git as git_module  # noqa: E402
+from git import GitPromiseTypeModule  # noqa: E402
+
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME="Test",
+    GIT_AUTHOR_EMAIL="test@example.com",
+    GIT_COMMITTER_NAME="Test",
+    GIT_COMMITTER_EMAIL="test@example.com",
+)
+
+
+def run_git(*args, cwd=None):
+    return (
+        subprocess.check_output(("git",) + args, cwd=cwd, env=GIT_ENV)
+        .strip()
+        .decode("utf-8")
+    )
+
+
+def commit(repository, name, content="content\n"):
+    with open(os.path.join(repository, name), "w") as f:
+        f.write(content)
+    run_git("add", name, cwd=repository)
+    run_git("commit", "-q", "-m", "Add " + name, cwd=repository)
+    return run_git("rev-parse", "HEAD", cwd=repository)
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    repository = str(tmp_path / "upstream")
+    run_git("init", "-q", "-b", "master", repository)
+    commit(repository, "first")
+    run_git("tag", "-a", "v1", "-m", "v1", cwd=repository)
+    return repository
+
+
+@pytest.fixture(autouse=True)
+def state_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "git_state.json")
+    monkeypatch.setattr(git_module, "STATE_FILE", path)
+    monkeypatch.setattr(git_module, "MIRRORS_DIR", str(tmp_path / "mirrors"))
+    return path
+
+
+def new_module():
+    module = GitPromiseTypeModule()
+    module._out = io.StringIO()
+    module._log_level = "info"
+    return module
+
+
+@pytest.fixture
+def module():
+    return new_module()
+
+
+@pytest.fixture
+def git_calls(monkeypatch):
+    """Record the git commands run by the module."""
+    calls = []
+    check_output = subprocess.check_output
+
+    def recording_check_output(args, **kwargs):
+        calls.append(args[1] if args[1] != "clone" else " ".join(args[1:3]))
+        return check_output(args, **kwargs)
+
+    monkeypatch.setattr(git_module.subprocess, "check_output", recording_check_output)
+    return calls
+
+
+def evaluate(module, destination, **attributes):
+    return module.evaluate_promise(destination, attributes, {})
+
+
+def test_clone(module, upstream, tmp_path):
+    destination = str(tmp_path / "clone")
+    result, classes = evaluate(
+        module, destination, repository=upstream, version="master"
+    )
+    assert result == Result.REPAIRED
+    assert classes == [destination + "_cloned"]
+    assert os.path.exists(os.path.join(destination, "first"))
+
+
+def test_kept_uses_three_git_commands(module, upstream, tmp_path, git_calls):
+    destination = str(tmp_path / "clone")
+    evaluate(module, destination, repository=upstream, version="master")
+    git_calls.clear()
+
+    result, _ = evaluate(module, destination, repository=upstream, version="master")
+
+    assert result == Result.KEPT
+    assert git_calls == ["rev-parse", "for-each-ref", "ls-remote"]
+
+
+def test_kept_with_force_adds_status(module, upstream, tmp_path, git_calls):
+    destination = str(tmp_path / "clone")
+    evaluate(module, destination, repository=upstream, version="master")
+    git_calls.clear()
+
+    result, _ = evaluate(
+        module, destination, repository=upstream, version="master", force=True
+    )
+
+    assert result == Result.KEPT
+    assert git_calls == ["status", "rev-parse", "for-each-ref", "ls-remote"]
+
+
+@pytest.mark.parametrize(
+    "version, expected_calls",
+    [
+        ("v1", ["rev-parse", "for-each-ref", "ls-remote"]),
+        # a commit which is already known is never fetched
+        ("commit", ["rev-parse", "for-each-ref"]),
+    ],
+)
+def test_kept_detached(module, upstream, tmp_path, git_calls, version, expected_calls):
+    if version == "commit":
+        version = run_git("rev-parse", "HEAD", cwd=upstream)
+    destination = str(tmp_path / "clone")
+    run_git("clone", "-q", upstream, destination)
+    run_git("checkout", "-q", version, cwd=destination)
+    git_calls.clear()
+
+    result, _ = evaluate(module, destination, repository=upstream, version=version)
+
+    assert result == Result.KEPT
+    assert git_calls == expected_calls
+
+
+def test_fetch_only_when_remote_ref_moved(module, upstream, tmp_path, git_calls):
+    destination = str(tmp_path / "clone")
+    evaluate(module, destination, repository=upstream, version="master")
+    new_commit = commit(upstream, "second")
+    git_calls.clear()
+
+    result, _ = evaluate(module, destination, repository=upstream, version="master")
+
+    assert result == Result.REPAIRED
+    assert git_calls[:4] == ["rev-parse", "for-each-ref", "ls-remote", "fetch"]
+    assert run_git("rev-parse", "HEAD", cwd=destination) == new_commit
+
+
+def test_fetch_interval(module, upstream, tmp_path, git_calls, state_file):
+    destination = str(tmp_path / "clone")
+    evaluate(module, destination, repository=upstream, version="master")
+    evaluate(
+        module, destination, repository=upstream, version="master", fetch_interval=300
+    )
+    with open(state_file) as f:
+        assert destination in json.load(f)["remote_checked"]
+    commit(upstream, "second")
+    git_calls.clear()
+
+    result, _ = evaluate(
+        module, destination, repository=upstream, version="master", fetch_interval=300
+    )
+
+    assert result == Result.KEPT
+    assert git_calls == ["rev-parse", "for-each-ref"]
+
+    # the remote is checked again once the interval is over
+    result, _ = evaluate(
+        module, destination, repository=upstream, version="master", fetch_interval=0
+    )
+    assert result == Result.REPAIRED
+
+
+def test_merge_new_upstream_commits(module, upstream, tmp_path):
+    destination = str(tmp_path / "clone")
+    evaluate(module, destination, repository=upstream, version="master")
+    new_commit = commit(upstream, "second")
+
+    result, _ = evaluate(module, destination, repository=upstream, version="master")
+
+    assert result == Result.REPAIRED
+    assert run_git("rev-parse", "HEAD", cwd=destination) == new_commit
+
+
+def test_local_commits_ahead_are_kept(module, upstream, tmp_path):
+    destination = str(tmp_path / "clone")
+    evaluate(module, destination, repository=upstream, version="master")
+    commit(destination, "local")
+
+    result, _ = evaluate(module, destination, repository=upstream, version="master")
+
+    assert result == Result.KEPT
+
+
+def test_checkout_other_branch(module, upstream, tmp_path):
+    destination = str(tmp_path / "clone")
+    evaluate(module, destination, repository=upstream, version="master")
+    run_git("checkout", "-q", "-b", "release", cwd=upstream)
+    release_commit = commit(upstream, "release")
+
+    result, _ = evaluate(module, destination, repository=upstream, version="release")
+
+    assert result == Result.REPAIRED
+    assert run_git("rev-parse", "--abbrev-ref", "HEAD", cwd=destination) == "release"
+    assert run_git("rev-parse", "HEAD", cwd=destination) == release_commit
+
+    result, _ = evaluate(module, destination, repository=upstream, version="release")
+    assert result == Result.KEPT
+
+
+@pytest.fixture
+def monorepo(upstream):
+    for directory in ("config", "docs", "services/web"):
+        os.makedirs(os.path.join(upstream, directory))
+        commit(upstream, os.path.join(directory, "file"))
+    run_git("config", "uploadpack.allowFilter", "true", cwd=upstream)
+    return upstream
+
+
+def test_partial_sparse_clone(module, monorepo, tmp_path):
+    destination = str(tmp_path / "clone")
+    result, _ = evaluate(
+        module,
+        destination,
+        repository="file://" + monorepo,
+        version="master",
+        filter="blob:none",
+        sparse_paths=["config", "/services/web/"],
+    )
+
+    assert result == Result.REPAIRED
+    assert sorted(os.listdir(destination)) == [".git", "config", "first", "services"]
+    assert run_git("config", "remote.origin.partialclonefilter", cwd=destination) == (
+        "blob:none"
+    )
+
+
+def test_sparse_paths_kept_in_sync(module, monorepo, tmp_path, git_calls):
+    destination = str(tmp_path / "clone")
+    attributes = dict(repository=monorepo, version="master", sparse_paths=["config"])
+    evaluate(module, destination, **attributes)
+    git_calls.clear()
+
+    result, _ = evaluate(module, destination, **attributes)
+    assert result == Result.KEPT
+    assert git_calls == ["sparse-checkout", "rev-parse", "for-each-ref", "ls-remote"]
+
+    attributes["sparse_paths"] = ["config", "docs"]
+    result, classes = evaluate(module, destination, **attributes)
+    assert result == Result.REPAIRED
+    assert destination + "_sparse_paths_changed" in classes
+    assert os.path.exists(os.path.join(destination, "docs", "file"))
+
+    attributes["sparse_paths"] = []
+    result, _ = evaluate(module, destination, **attributes)
+    assert result == Result.REPAIRED
+    assert os.path.exists(os.path.join(destination, "services", "web", "file"))
+
+
+def test_mirror_fetched_once_per_run(module, upstream, tmp_path, git_calls):
+    destinations = [str(tmp_path / name) for name in ("staging", "production")]
+    for destination in destinations:
+        result, _ = evaluate(
+            module, destination, repository=upstream, version="master", mirror=True
+        )
+        assert result == Result.REPAIRED
+        assert run_git("remote", "get-url", "origin", cwd=destination) == upstream
+        alternates = os.path.join(destination, ".git", "objects", "info", "alternates")
+        assert os.path.exists(alternates)
+    assert git_calls.count("clone --mirror") == 1
+
+    new_commit = commit(upstream, "second")
+    # next agent run
+    module = new_module()
+    git_calls.clear()
+    for destination in destinations:
+        result, _ = evaluate(
+            module, destination, repository=upstream, version="master", mirror=True
+        )
+        assert result == Result.REPAIRED
+        assert run_git("rev-parse", "HEAD", cwd=destination) == new_commit
+    # one fetch of the mirror, and one local fetch from it per destination
+    assert git_calls.count("fetch") == 3
+    assert "clone --mirror" not in git_calls
+
+
+def test_mirror_keeps_objects_of_branches_deleted_upstream(module, upstream, tmp_path):
+    run_git("checkout", "-q", "-b", "feature", cwd=upstream)
+    feature_commit = commit(upstream, "feature")
+    run_git("checkout", "-q", "master", cwd=upstream)
+    destination = str(tmp_path / "feature")
+    evaluate(module, destination, repository=upstream, version="feature", mirror=True)
+
+    run_git("branch", "-q", "-D", "feature", cwd=upstream)
+    # next agent run, pruning the branch from the mirror
+    evaluate(
+        new_module(),
+        str(tmp_path / "master"),
+        repository=upstream,
+        version="master",
+        mirror=True,
+    )
+    mirror = os.path.join(git_module.MIRRORS_DIR, os.listdir(git_module.MIRRORS_DIR)[0])
+    assert "feature" not in run_git("branch", cwd=mirror)
+
+    # objects older than the default prune expiry of two weeks
+    month_ago = time.time() - 30 * 24 * 3600
+    for root, _, files in os.walk(os.path.join(mirror, "objects")):
+        for name in files:
+            os.utime(os.path.join(root, name), (month_ago, month_ago))
+    run_git("gc", "-q", cwd=mirror)
+
+    # the checkout still has the objects it borrows from the mirror
+    run_git("fsck", cwd=destination)
+    assert run_git("rev-parse", "HEAD", cwd=destination) == feature_commit
+
+
+def test_background_fetch_of_known_repositories(upstream, tmp_path, git_calls):
+    destinations = [str(tmp_path / name) for name in ("one", "two")]
+    module = new_module()
+    module.protocol_init(None)
+    for destination in destinations:
+        evaluate(module, destination, repository=upstream, version="master")
+        evaluate(module, destination, repository=upstream, version="master")
+    module.protocol_terminate()
+    new_commit = commit(upstream, "second")
+
+    # next agent run, which fetches both repositories at init
+    module = new_module()
+    module._log_level = "verbose"
+    module.protocol_init(None)
+    for prefetch in module._prefetches.values():
+        prefetch.result()
+    assert git_calls.count("fetch") == 2
+    git_calls.clear()
+
+    results = [
+        evaluate(module, destination, repository=upstream, version="master")[0]
+        for destination in destinations
+    ]
+    # only reading the refs and the merge are left to the evaluation
+    assert git_calls == ["rev-parse", "for-each-ref", "merge-base", "merge"] * 2
+    assert results == [Result.REPAIRED] * 2
+    for destination in destinations:
+        assert run_git("rev-parse", "HEAD", cwd=destination) == new_commit
+    # the messages of the background fetch are logged by the evaluation
+    assert "Run: git fetch origin" in module._out.getvalue()
+    module.protocol_terminate()
+
+
+def test_checkout_changed_during_background_fetch(upstream, tmp_path):
+    destination = str(tmp_path / "clone")
+    module = new_module()
+    evaluate(module, destination, repository=upstream, version="master")
+    evaluate(module, destination, repository=upstream, version="master")
+    new_commit = commit(upstream, "second")
+
+    module = new_module()
+    module.protocol_init(None)
+    for prefetch in module._prefetches.values():
+        prefetch.result()
+    # switched to another branch once the fetch is done
+    run_git("checkout", "-q", "-b", "other", cwd=destination)
+
+    result, _ = evaluate(module, destination, repository=upstream, version="master")
+    assert result == Result.REPAIRED
+    assert run_git("symbolic-ref", "HEAD", cwd=destination) == "refs/heads/master"
+    assert run_git("rev-parse", "HEAD", cwd=destination) == new_commit
+    module.protocol_terminate()
+
+
+def test_attributes_changed_during_background_fetch(upstream, tmp_path, monkeypatch):
+    destination = str(tmp_path / "clone")
+    module = new_module()
+    evaluate(module, destination, repository=upstream, version="master")
+    evaluate(module, destination, repository=upstream, version="master")
+    new_commit = commit(upstream, "second")
+    run_git("tag", "-a", "v2", "-m", "v2", cwd=upstream)
+
+    # the background fetch is held until the promise is evaluated
+    calls = []
+    release = threading.Event()
+    check_output = subprocess.check_output
+
+    def slow_check_output(args, **kwargs):
+        background = threading.current_thread() is not threading.main_thread()
+        calls.append(("start", background, args[1]))
+        if background and args[1] == "fetch":
+            release.wait(10)
+        try:
+            return check_output(args, **kwargs)
+        finally:
+            calls.append(("end", background, args[1]))
+
+    monkeypatch.setattr(git_module.subprocess, "check_output", slow_check_output)
+    module = new_module()
+    module._log_level = "verbose"
+    module.protocol_init(None)
+    threading.Timer(0.2, release.set).start()
+
+    result, _ = evaluate(module, destination, repository=upstream, version="v2")
+    assert result == Result.REPAIRED
+    assert run_git("rev-parse", "HEAD", cwd=destination) == new_commit
+    # the promise waited for the background fetch before running git
+    backgrounds = [background for _, background, _ in calls]
+    assert ("end", True, "fetch") in calls
+    assert backgrounds == sorted(backgrounds, reverse=True)
+    # whose messages are logged by the evaluation
+    assert "Run: git fetch origin" in module._out.getvalue()
+    module.protocol_terminate()
+
+
+def test_repositories_no_longer_promised_are_forgotten(upstream, tmp_path, state_file):
+    destination = str(tmp_path / "clone")
+    module = new_module()
+    evaluate(module, destination, repository=upstream, version="master")
+    evaluate(module, destination, repository=upstream, version="master")
+    with open(state_file) as f:
+        assert destination in json.load(f)["repositories"]
+
+    module = new_module()
+    module.protocol_init(None)
+    module.protocol_terminate()
+    with open(state_file) as f:
+        assert destination not in json.load(f)["repositories"]
+
+
+def test_worktrees_of_one_mirror(module, upstream, tmp_path, git_calls):
+    blue, green = str(tmp_path / "blue"), str(tmp_path / "green")
+    tag_commit = run_git("rev-parse", "v1^{commit}", cwd=upstream)
+    new_commit = commit(upstream, "second")
+
+    for destination, version in ((blue, "v1"), (green, "master")):
+        result, classes = evaluate(
+            module, destination, repository=upstream, version=version, worktree=True
+        )
+        assert result == Result.REPAIRED
+        assert classes == [destination + "_cloned"]
+    assert git_calls.count("clone --mirror") == 1
+    for destination in (blue, green):
+        # a worktree has a .git file pointing to the mirror
+        assert os.path.isfile(os.path.join(destination, ".git"))
+    assert run_git("rev-parse", "HEAD", cwd=blue) == tag_commit
+    assert run_git("rev-parse", "HEAD", cwd=green) == new_commit
+
+    result, _ = evaluate(
+        module, green, repository=upstream, version="master", worktree=True
+    )
+    assert result == Result.KEPT
+
+    # switching versions is a local checkout, the mirror was already fetched
+    git_calls.clear()
+    result, _ = evaluate(
+        module, blue, repository=upstream, version="master", worktree=True
+    )
+    assert result == Result.REPAIRED
+    assert git_calls == ["rev-parse", "checkout"]
+    assert run_git("rev-parse", "HEAD", cwd=blue) == new_commit
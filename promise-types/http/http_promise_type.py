@@ -1,27 +1,390 @@
 """HTTP module for CFEngine"""
 
-import filecmp
+import hashlib
+import http.client
 import os
+import select
+import shutil
+import socket
+import stat
+import string
+import tempfile
 import urllib.error
+import urllib.parse
 import urllib.request
 import ssl
 import json
+import zlib
 from contextlib import contextmanager
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from cfengine_module_library import PromiseModule, ValidationError, Result
 
+STATE_FILE = "/var/cfengine/state/http_promise_state.json"
+
 _SUPPORTED_METHODS = {"GET", "POST", "PUT", "DELETE", "PATCH"}
+# methods which can safely be sent again if the connection breaks (RFC 9110)
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"}
+_REDIRECT_CODES = {301, 302, 303, 307, 308}
+_MAX_REDIRECTS = 10
+_USER_AGENT = "Python-urllib/%s" % urllib.request.__version__
+_CHUNK_SIZE = 512 * 1024
+# checksum attributes and the length of their hexadecimal digests
+_CHECKSUM_ALGORITHMS = {"sha256": 64, "sha512": 128}
+_FICLONE = 0x40049409  # from linux/fs.h
+# content encodings supported for responses and payloads, preferred first
+_ENCODINGS = (["zstd"] if zstandard else []) + ["gzip", "deflate"]
+_DECOMPRESSION_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard else ())
 
 
 class FileInfo:
-    def __init__(self, target):
+    def __init__(self, target, checksums):
         self.target = target
+        self.checksums = checksums
+        self.offset = 0
+        self.content_encoding = None
+        self.digests = {}
         self.was_repaired = False
+        self.checksum_failed = None
+
+
+def _update_hashes(hashes, path, buffer):
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        size = f.readinto(buffer)
+        while size:
+            for hash_ in hashes:
+                hash_.update(view[:size])
+            size = f.readinto(buffer)
+
+
+def _file_digest(path, algorithm, buffer):
+    digest = hashlib.new(algorithm)
+    _update_hashes([digest], path, buffer)
+    return digest.hexdigest()
+
+
+def _compressor(encoding):
+    if encoding == "gzip":
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.compressobj()
+    return zstandard.ZstdCompressor().compressobj()
+
+
+class _DeflateDecompressor:
+    """Decompressor of deflate responses, which are zlib streams but raw deflate
+    data (without the zlib header) from some servers"""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+        # the data received until the zlib header is checked
+        self._head = b""
+
+    def decompress(self, data):
+        if self._head is None:
+            return self._decompressor.decompress(data)
+        self._head += data
+        try:
+            output = self._decompressor.decompress(data)
+        except zlib.error:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            output = self._decompressor.decompress(self._head)
+        if len(self._head) >= 2:
+            self._head = None
+        return output
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+def _decompressor(encoding):
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return _DeflateDecompressor()
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _compress_payload(payload, encoding):
+    """Compressed payload, bytes for bytes and a temporary file for a file"""
+    compressor = _compressor(encoding)
+    if isinstance(payload, bytes):
+        return compressor.compress(payload) + compressor.flush()
+    compressed = tempfile.TemporaryFile()
+    chunk = payload.read(_CHUNK_SIZE)
+    while chunk:
+        compressed.write(compressor.compress(chunk))
+        chunk = payload.read(_CHUNK_SIZE)
+    compressed.write(compressor.flush())
+    compressed.seek(0)
+    return compressed
+
+
+def _validators(response):
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def _conditional_headers(validators):
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def _copy_file(src, dst, hardlink=False):
+    """Make dst a reflink or else a copy of src, or a hardlink if allowed"""
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+        try:
+            if fcntl is None:
+                raise OSError("no reflinks without fcntl")
+            fcntl.ioctl(dst_f.fileno(), _FICLONE, src_f.fileno())
+        except OSError:
+            shutil.copyfileobj(src_f, dst_f, _CHUNK_SIZE)
+
+
+def _is_dropped(connection):
+    """Whether the server closed the idle connection (or sent something
+    unexpected on it)"""
+    if connection.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection resuming the TLS session of its previous socket when it
+    has to connect again, e.g. after the server closed an idle connection"""
+
+    tls_session = None
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self.host, session=self.tls_session
+        )
+
+    def close(self):
+        if self.sock is not None and getattr(self.sock, "session", None):
+            self.tls_session = self.sock.session
+        super().close()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections shared by all the promises evaluated
+    during the agent run, by scheme, host, port and TLS settings"""
+
+    def __init__(self):
+        self._connections = {}
+        self._ssl_contexts = {}
+
+    def ssl_context(self, insecure):
+        context = self._ssl_contexts.get(insecure)
+        if context is None:
+            context = ssl.create_default_context()
+            if insecure:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self._ssl_contexts[insecure] = context
+        return context
+
+    @contextmanager
+    def open(self, url, method, payload, headers, insecure):
+        """Send the request, following redirects the way urllib does, and
+        yield the response
+
+        Network errors are raised as urllib.error.URLError, like urlopen() does.
+        """
+        headers = dict(headers)
+        headers.setdefault("User-Agent", _USER_AGENT)
+        for _ in range(_MAX_REDIRECTS + 1):
+            key, response = self._request(url, method, payload, headers, insecure)
+            location = response.getheader("Location")
+            if not (
+                location
+                and response.status in _REDIRECT_CODES
+                and (
+                    method in ("GET", "HEAD")
+                    or (method == "POST" and response.status in (301, 302, 303))
+                )
+            ):
+                break
+            # read the rest of the response to be able to reuse the connection
+            response.read()
+            url = urllib.parse.urljoin(url, location)
+            if method == "POST":
+                method = "GET"
+                payload = None
+                for name in ("Content-Length", "Content-Type"):
+                    headers.pop(name, None)
+        try:
+            yield response
+        finally:
+            if response.length == 0:
+                # e.g. 304 Not Modified, nothing to read
+                response.read()
+            if not response.isclosed():
+                # the rest of the response would be read as the next one
+                self.close(key)
+
+    def close(self, key=None):
+        keys = [key] if key else list(self._connections)
+        for key in keys:
+            connection = self._connections.pop(key, None)
+            if connection is not None:
+                connection.close()
+
+    def _request(self, url, method, payload, headers, insecure):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port, insecure)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        connection = self._connections.get(key)
+        reused = connection is not None
+        if connection is None:
+            if parts.scheme == "https":
+                connection = _HTTPSConnection(
+                    parts.hostname, parts.port, context=self.ssl_context(insecure)
+                )
+            else:
+                connection = http.client.HTTPConnection(parts.hostname, parts.port)
+            self._connections[key] = connection
+
+        idempotent = method in _IDEMPOTENT_METHODS
+        if reused and not idempotent and _is_dropped(connection):
+            # connect again now, the request can't be sent twice
+            connection.close()
+        try:
+            try:
+                connection.request(method, path, body=payload, headers=headers)
+                return (key, connection.getresponse())
+            except (ConnectionResetError, BrokenPipeError):
+                # http.client.RemoteDisconnected is a ConnectionResetError
+                if not reused or not idempotent:
+                    # the server may have received (and processed) it
+                    raise
+                # the server closed the idle connection, try again on a new one
+                connection.close()
+                if hasattr(payload, "seek"):
+                    payload.seek(0)
+                connection.request(method, path, body=payload, headers=headers)
+                return (key, connection.getresponse())
+        except (OSError, http.client.HTTPException) as e:
+            self.close(key)
+            raise urllib.error.URLError(e)
+
+
+class DownloadCache:
+    """Content-addressed cache of downloaded files, shared by the promises (and
+    hosts) using the same directory
+
+    Files are stored once under sha256/<xx>/<digest>, and the digest and
+    validators of the last response from each URL under urls/<hash of URL>.json.
+    Both are only ever replaced atomically. The files are only hardlinked to
+    and from the cache if allowed, since a hardlinked file changed in place
+    changes the cached one too.
+    """
+
+    def __init__(self, path, hardlinks=False):
+        self.path = path
+        self.hardlinks = hardlinks
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "sha256", digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.isfile(self.object_path(digest))
+
+    def lookup(self, url):
+        """Index entry of the URL, None if there is none or its file is gone"""
+        try:
+            with open(self._index_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            not isinstance(entry, dict)
+            or entry.get("url") != url
+            or not self.has(entry.get("sha256", ""))
+        ):
+            return None
+        return entry
+
+    def store(self, url, path, validators, digest):
+        """Store the file downloaded from the URL, if it isn't cached yet, and
+        index it"""
+        object_path = self.object_path(digest)
+        if not os.path.isfile(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = self._tmp_path(object_path)
+            _copy_file(path, tmp_path, self.hardlinks)
+            os.replace(tmp_path, object_path)
+
+        index_path = self._index_path(url)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp_path = self._tmp_path(index_path)
+        with open(tmp_path, "w") as f:
+            json.dump(dict(url=url, sha256=digest, **validators), f)
+        os.replace(tmp_path, index_path)
+
+    def populate(self, digest, target):
+        """Replace the target with the cached file"""
+        temp_file = target + ".cftemp"
+        try:
+            os.remove(temp_file)
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        _copy_file(self.object_path(digest), temp_file, self.hardlinks)
+        os.replace(temp_file, target)
+
+    def remove(self, digest):
+        try:
+            os.remove(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _index_path(self, url):
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "urls", name + ".json")
+
+    @staticmethod
+    def _tmp_path(path):
+        # unique among the hosts sharing the cache
+        return "%s.%s.%d.tmp" % (path, socket.gethostname(), os.getpid())
 
 
 class HTTPPromiseModule(PromiseModule):
     def __init__(self, name="http_promise_module", version="0.0.0", **kwargs):
         super().__init__(name, version, **kwargs)
+        self._pool = ConnectionPool()
+        self._state = None
+        self._buffer = bytearray(_CHUNK_SIZE)
 
     def validate_promise(self, promiser, attributes, metadata):
         if "url" in attributes:
@@ -92,17 +455,85 @@ class HTTPPromiseModule(PromiseModule):
             ):
                 raise ValidationError('\'insecure\' must be either "true" or "false"')
 
+        if "compression" in attributes:
+            compression = attributes["compression"]
+            if not isinstance(compression, str) or compression not in (
+                "true",
+                "True",
+                "false",
+                "False",
+            ):
+                raise ValidationError(
+                    '\'compression\' must be either "true" or "false"'
+                )
+
+        if "payload_encoding" in attributes:
+            payload_encoding = attributes["payload_encoding"]
+            if payload_encoding == "zstd" and not zstandard:
+                raise ValidationError(
+                    "'payload_encoding' zstd requires the zstandard Python module"
+                )
+            if payload_encoding not in ("gzip", "deflate", "zstd"):
+                raise ValidationError(
+                    "'payload_encoding' must be one of gzip, deflate, zstd"
+                )
+
+        for algorithm, length in _CHECKSUM_ALGORITHMS.items():
+            if algorithm not in attributes:
+                continue
+            checksum = attributes[algorithm]
+            if (
+                not isinstance(checksum, str)
+                or len(checksum) != length
+                or any(char not in string.hexdigits for char in checksum)
+            ):
+                raise ValidationError(
+                    "'%s' must be a hexadecimal digest of %d characters"
+                    % (algorithm, length)
+                )
+            if "file" not in attributes or attributes.get("method", "GET") != "GET":
+                raise ValidationError(
+                    "'%s' can only be used for GET requests with a 'file'" % algorithm
+                )
+
+        if "cache_hardlinks" in attributes:
+            cache_hardlinks = attributes["cache_hardlinks"]
+            if not isinstance(cache_hardlinks, str) or cache_hardlinks not in (
+                "true",
+                "True",
+                "false",
+                "False",
+            ):
+                raise ValidationError(
+                    '\'cache_hardlinks\' must be either "true" or "false"'
+                )
+            if "cache_dir" not in attributes:
+                raise ValidationError("'cache_hardlinks' requires a 'cache_dir'")
+
+        if "cache_dir" in attributes:
+            cache_dir = attributes["cache_dir"]
+            if not isinstance(cache_dir, str) or not os.path.isabs(cache_dir):
+                raise ValidationError("'cache_dir' must be an absolute path")
+            if "file" not in attributes or attributes.get("method", "GET") != "GET":
+                raise ValidationError(
+                    "'cache_dir' can only be used for GET requests with a 'file'"
+                )
+
     @contextmanager
     def target_fh(self, file_info):
         if file_info.target:
             dirname = os.path.dirname(file_info.target)
             os.makedirs(dirname, exist_ok=True)
             temp_file = file_info.target + ".cftemp"
-            with open(temp_file, "wb") as fh:
+            # a partial download is resumed, anything else starts from scratch
+            with open(temp_file, "ab" if file_info.offset else "wb") as fh:
                 yield fh
-            if not os.path.isfile(file_info.target) or not filecmp.cmp(
-                temp_file, file_info.target
-            ):
+            for algorithm, checksum in file_info.checksums.items():
+                if file_info.digests[algorithm] != checksum:
+                    os.remove(temp_file)
+                    file_info.checksum_failed = algorithm
+                    return
+            if file_info.digests["sha256"] != self._target_digest(file_info.target):
                 os.replace(temp_file, file_info.target)
                 file_info.was_repaired = True
             else:
@@ -111,6 +542,221 @@ class HTTPPromiseModule(PromiseModule):
             # this is to do something like API requests where you don't care about the result other than response code
             yield open(os.devnull, "wb")
 
+    def _save_response(self, response, file_info):
+        """Save the response to the target, hashing it on the way"""
+        hashes = {
+            algorithm: hashlib.new(algorithm)
+            for algorithm in ("sha256", *file_info.checksums)
+        }
+        if file_info.offset:
+            _update_hashes(hashes.values(), file_info.target + ".cftemp", self._buffer)
+        decompressor = None
+        if file_info.content_encoding:
+            decompressor = _decompressor(file_info.content_encoding)
+        view = memoryview(self._buffer)
+        with self.target_fh(file_info) as target_file:
+            try:
+                size = response.readinto(self._buffer)
+                while size:
+                    data = view[:size]
+                    if decompressor:
+                        data = decompressor.decompress(data)
+                    for hash_ in hashes.values():
+                        hash_.update(data)
+                    target_file.write(data)
+                    size = response.readinto(self._buffer)
+                if response.length:
+                    raise urllib.error.URLError(
+                        "connection closed with %d bytes of the response left"
+                        % response.length
+                    )
+                if decompressor:
+                    data = decompressor.flush()
+                    for hash_ in hashes.values():
+                        hash_.update(data)
+                    target_file.write(data)
+            except _DECOMPRESSION_ERRORS as e:
+                raise urllib.error.URLError(
+                    "invalid %s response: %s" % (file_info.content_encoding, e)
+                )
+            file_info.digests = {
+                algorithm: hash_.hexdigest() for algorithm, hash_ in hashes.items()
+            }
+
+    def open_url(self, url, method, payload, headers, insecure):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme in urllib.request.getproxies() and not (
+            urllib.request.proxy_bypass(parts.hostname)
+        ):
+            # leave proxies to urllib, without connection reuse
+            request = urllib.request.Request(
+                url=url, data=payload, method=method, headers=headers
+            )
+            SSL_context = self._pool.ssl_context(insecure) if insecure else None
+            try:
+                return urllib.request.urlopen(request, context=SSL_context)
+            except urllib.error.HTTPError as e:
+                # checked like the responses from the pool (e.g. 304)
+                return e
+        return self._pool.open(url, method, payload, headers, insecure)
+
+    def _conditional_headers(self, url, target):
+        """Validators to send to only get the response if the target changed
+
+        Only sent if the target is still the file saved from the response they
+        come from.
+        """
+        record = self._get_state("targets").get(target)
+        if not record or record.get("url") != url:
+            return {}
+        try:
+            st = os.stat(target)
+        except OSError:
+            return {}
+        if (st.st_size, st.st_mtime_ns) != (record["size"], record["mtime_ns"]):
+            return {}
+        return _conditional_headers(record)
+
+    def _partial_download(self, url, target):
+        """Offset and headers to resume the interrupted download of the target,
+        (0, {}) if there is nothing to resume"""
+        record = self._get_state("partials").get(target)
+        if not record or record.get("url") != url:
+            return (0, {})
+        # If-Range needs a strong validator, the whole response is sent if the
+        # resource changed since the partial download started
+        validator = record.get("last_modified")
+        if record.get("etag") and not record["etag"].startswith("W/"):
+            validator = record["etag"]
+        try:
+            offset = os.path.getsize(target + ".cftemp")
+        except OSError:
+            return (0, {})
+        if not validator or not offset:
+            return (0, {})
+        return (offset, {"Range": "bytes=%d-" % offset, "If-Range": validator})
+
+    def _remember_partial(self, url, target, response):
+        """Remember where the download to the temp file comes from, to be able
+        to resume it if it gets interrupted"""
+        self._get_state("partials")[target] = dict(url=url, **_validators(response))
+        self._save_state()
+
+    def _forget_partial(self, target):
+        if self._get_state("partials").pop(target, None):
+            self._save_state()
+
+    def _target_digest(self, target, algorithm="sha256"):
+        """Digest of the target, from the state unless the file was changed
+        since it was recorded, None if there is no such file"""
+        try:
+            st = os.stat(target)
+        except FileNotFoundError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        targets = self._get_state("targets")
+        record = targets.get(target)
+        if not record or (st.st_size, st.st_mtime_ns) != (
+            record["size"],
+            record["mtime_ns"],
+        ):
+            # not (or no longer) the file saved from a response
+            record = {
+                "url": None,
+                "etag": None,
+                "last_modified": None,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+            }
+            targets[target] = record
+        if algorithm not in record:
+            record[algorithm] = _file_digest(target, algorithm, self._buffer)
+            self._save_state()
+        return record[algorithm]
+
+    def _remember_target(self, url, target, validators, digests):
+        """Remember the digest of the saved target, and the validators of the
+        response it comes from if it can be requested conditionally"""
+        targets = self._get_state("targets")
+        self._get_state("partials").pop(target, None)
+        try:
+            st = os.stat(target)
+        except OSError:
+            targets.pop(target, None)
+        else:
+            targets[target] = {
+                "url": url,
+                "etag": validators and validators.get("etag"),
+                "last_modified": validators and validators.get("last_modified"),
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                **digests,
+            }
+        self._save_state()
+
+    def _copy_from_cache(self, cache, digest, target, checksums):
+        """Replace the target with the cached file, False if there is no such
+        file or it doesn't match its digest and the checksums"""
+        if not self._is_cached(cache, digest, checksums):
+            return False
+        cache.populate(digest, target)
+        self._remember_target(None, target, None, dict(checksums, sha256=digest))
+        return True
+
+    def _is_cached(self, cache, digest, checksums):
+        """Whether the cached file with the digest exists and matches it and
+        the checksums, a file not matching them is removed from the cache"""
+        path = cache.object_path(digest)
+        try:
+            matches = all(
+                _file_digest(path, algorithm, self._buffer) == checksum
+                for algorithm, checksum in dict(checksums, sha256=digest).items()
+            )
+        except OSError:
+            return False
+        if not matches:
+            self.log_warning(
+                "Cached file '%s' doesn't match its checksum, removing it" % path
+            )
+            cache.remove(digest)
+        return matches
+
+    def _store_in_cache(self, cache, url, target, validators, digest):
+        try:
+            cache.store(url, target, validators, digest)
+        except OSError as e:
+            self.log_warning(
+                "Failed to store '%s' in the download cache '%s': %s"
+                % (target, cache.path, e)
+            )
+
+    def _get_state(self, section):
+        if self._state is None:
+            try:
+                with open(STATE_FILE) as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                self._state = {}
+            if not isinstance(self._state, dict):
+                self._state = {}
+        return self._state.setdefault(section, {})
+
+    def _save_state(self):
+        tmp_path = STATE_FILE + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self._state, f)
+            os.replace(tmp_path, STATE_FILE)
+        except OSError as e:
+            self.log_warning("Failed to save http promise state: %s" % e)
+
+    def protocol_terminate(self):
+        self._pool.close()
+        return Result.SUCCESS
+
     def evaluate_promise(self, promiser, attributes, metadata):
         url = attributes.get("url", promiser)
         method = attributes.get("method", "GET")
@@ -118,12 +764,58 @@ class HTTPPromiseModule(PromiseModule):
         payload = attributes.get("payload")
         target = attributes.get("file")
         insecure = attributes.get("insecure", False)
+        compression = attributes.get("compression", "false").lower() == "true"
+        payload_encoding = attributes.get("payload_encoding")
+        checksums = {
+            algorithm: attributes[algorithm].lower()
+            for algorithm in _CHECKSUM_ALGORITHMS
+            if algorithm in attributes
+        }
+        cache = None
+        if "cache_dir" in attributes:
+            hardlinks = attributes.get("cache_hardlinks", "false").lower() == "true"
+            cache = DownloadCache(attributes["cache_dir"], hardlinks)
         result = Result.KEPT
 
         canonical_promiser = promiser.translate(
             str.maketrans({char: "_" for char in ("@", "/", ":", "?", "&", "%")})
         )
 
+        from_cache = False
+        try:
+            up_to_date = checksums and all(
+                self._target_digest(target, algorithm) == checksum
+                for algorithm, checksum in checksums.items()
+            )
+            if not up_to_date and cache and "sha256" in checksums:
+                from_cache = self._copy_from_cache(
+                    cache, checksums["sha256"], target, checksums
+                )
+        except OSError as e:
+            self.log_error("Failed to check the checksum of '%s': %s" % (target, e))
+            return (
+                Result.NOT_KEPT,
+                [
+                    "%s_%s_request_failed" % (canonical_promiser, method),
+                    "%s_%s_file_failed" % (canonical_promiser, method),
+                ],
+            )
+        if up_to_date:
+            self.log_info(
+                "'%s' already has the expected checksum, not requesting '%s'"
+                % (target, url)
+            )
+            return (Result.KEPT, ["%s_%s_request_done" % (canonical_promiser, method)])
+        if from_cache:
+            self.log_info(
+                "Copied '%s' to '%s' from the download cache, not requesting '%s'"
+                % (cache.object_path(checksums["sha256"]), target, url)
+            )
+            return (
+                Result.REPAIRED,
+                ["%s_%s_request_done" % (canonical_promiser, method)],
+            )
+
         if headers and not isinstance(headers, dict):
             if isinstance(headers, str):
                 headers = {
@@ -184,22 +876,93 @@ class HTTPPromiseModule(PromiseModule):
             if isinstance(payload, str):
                 payload = payload.encode("utf-8")
 
-        request = urllib.request.Request(
-            url=url, data=payload, method=method, headers=headers
-        )
+            if payload_encoding:
+                try:
+                    payload = _compress_payload(payload, payload_encoding)
+                except OSError as e:
+                    self.log_error(
+                        "Failed to compress payload file for request '%s': %s"
+                        % (url, e)
+                    )
+                    return (
+                        Result.NOT_KEPT,
+                        [
+                            "%s_%s_request_failed" % (canonical_promiser, method),
+                            "%s_%s_payload_failed" % (canonical_promiser, method),
+                            "%s_%s_payload_file_failed" % (canonical_promiser, method),
+                        ],
+                    )
+                headers["Content-Encoding"] = payload_encoding
+                if not isinstance(payload, bytes):
+                    headers["Content-Length"] = str(os.fstat(payload.fileno()).st_size)
+
+        # not to change the attributes with the headers added below
+        headers = dict(headers)
 
-        SSL_context = None
         if insecure:
             # convert to a boolean
             insecure = insecure.lower() == "true"
-            if insecure:
-                SSL_context = ssl.create_default_context()
-                SSL_context.check_hostname = False
-                SSL_context.verify_mode = ssl.CERT_NONE
+
+        offset = 0
+        if target and method == "GET":
+            offset, range_headers = self._partial_download(url, target)
+            headers.update(range_headers)
+        # with a checksum, the target is known to be outdated here, and so it is
+        # with a partial download of it
+        conditional = target and method == "GET" and not checksums and not offset
+        # ranges of a partial download are ranges of the decoded response
+        if compression and not offset:
+            headers.setdefault("Accept-Encoding", ", ".join(_ENCODINGS))
+        cached = None
+        if conditional:
+            conditional_headers = self._conditional_headers(url, target)
+            if not conditional_headers and cache:
+                # the response may still be the one in the cache
+                cached = cache.lookup(url)
+                # checked now, a 304 response makes the target a copy of it
+                if cached and not self._is_cached(cache, cached["sha256"], {}):
+                    cached = None
+                if cached:
+                    conditional_headers = _conditional_headers(cached)
+            for name, value in conditional_headers.items():
+                headers.setdefault(name, value)
+
+        restart = False
 
         try:
-            with urllib.request.urlopen(request, context=SSL_context) as url_req:
-                if not (200 <= url_req.status < 300):
+            with self.open_url(url, method, payload, headers, insecure) as url_req:
+                if cached and url_req.status == 304:
+                    cache.populate(cached["sha256"], target)
+                    self._remember_target(
+                        url, target, cached, {"sha256": cached["sha256"]}
+                    )
+                    self.log_info(
+                        "Copied response from '%s' to '%s' from the download cache"
+                        % (url, target)
+                    )
+                    return (
+                        Result.REPAIRED,
+                        ["%s_%s_request_done" % (canonical_promiser, method)],
+                    )
+                if conditional and url_req.status == 304:
+                    self.log_info(
+                        "No changes in request response from '%s' to '%s'"
+                        % (url, target)
+                    )
+                    return (
+                        Result.KEPT,
+                        ["%s_%s_request_done" % (canonical_promiser, method)],
+                    )
+                content_range = url_req.headers.get("Content-Range", "")
+                if offset and (
+                    url_req.status == 416
+                    or (
+                        url_req.status == 206
+                        and not content_range.startswith("bytes %d-" % offset)
+                    )
+                ):
+                    restart = True
+                elif not (200 <= url_req.status < 300):
                     self.log_error(
                         "Request for '%s' failed with code %d" % (url, url_req.status)
                     )
@@ -207,17 +970,55 @@ class HTTPPromiseModule(PromiseModule):
                         Result.NOT_KEPT,
                         ["%s_%s_request_failed" % (canonical_promiser, method)],
                     )
-                # TODO: log progress when url_req.headers["Content-length"] > REPORTING_THRESHOLD
-                file_info = FileInfo(target)
-                with self.target_fh(file_info) as target_file:
-                    should_read = True
-                    while should_read:
-                        data = url_req.read(512 * 1024)
-                        target_file.write(data)
-                        should_read = bool(data)
-                if file_info.was_repaired:
-                    result = Result.REPAIRED
-        except urllib.error.URLError as e:
+                else:
+                    # TODO: log progress when url_req.headers["Content-length"] > REPORTING_THRESHOLD
+                    file_info = FileInfo(target, checksums)
+                    if url_req.status == 206:
+                        file_info.offset = offset
+                    encoding = url_req.headers.get("Content-Encoding", "identity")
+                    encoding = encoding.strip().lower()
+                    if compression and encoding in _ENCODINGS:
+                        file_info.content_encoding = encoding
+                    # encoded responses can't be resumed from the decoded data
+                    if target and method == "GET" and encoding == "identity":
+                        self._remember_partial(url, target, url_req)
+                    self._save_response(url_req, file_info)
+                    if file_info.checksum_failed:
+                        self._forget_partial(target)
+                        self.log_error(
+                            "Response from '%s' doesn't match the expected %s checksum, '%s' left unchanged"
+                            % (url, file_info.checksum_failed, target)
+                        )
+                        return (
+                            Result.NOT_KEPT,
+                            [
+                                "%s_%s_request_failed" % (canonical_promiser, method),
+                                "%s_%s_checksum_failed" % (canonical_promiser, method),
+                            ],
+                        )
+                    if target:
+                        validators = _validators(url_req) if method == "GET" else None
+                        self._remember_target(
+                            url, target, validators, file_info.digests
+                        )
+                        if cache:
+                            self._store_in_cache(
+                                cache,
+                                url,
+                                target,
+                                validators,
+                                file_info.digests["sha256"],
+                            )
+                    if file_info.was_repaired:
+                        result = Result.REPAIRED
+            if restart:
+                self.log_verbose(
+                    "Can't resume the download of '%s' to '%s', starting again"
+                    % (url, target)
+                )
+                self._forget_partial(target)
+                os.remove(target + ".cftemp")
+        except (urllib.error.URLError, http.client.HTTPException) as e:
             self.log_error("Failed to request '%s': %s" % (url, e))
             return (
                 Result.NOT_KEPT,
@@ -235,6 +1036,9 @@ class HTTPPromiseModule(PromiseModule):
                 ],
             )
 
+        if restart:
+            return self.evaluate_promise(promiser, attributes, metadata)
+
         if target:
             if result == Result.REPAIRED:
                 self.log_info(
@@ -0,0 +1,489 @@
+import gzip
+import hashlib
+import http.server
+import io
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import threading
+import zlib
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../libraries/python"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cfengine_module_library import Result  # noqa: E402
+
+import http_promise_type  # noqa: E402
+from http_promise_type import HTTPPromiseModule  # noqa: E402
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serve the files of the server, recording the requests"""
+
+    protocol_version = "HTTP/1.1"
+    # don't hold the body back until the headers are acknowledged
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        if getattr(self.connection, "session_reused", False):
+            self.server.resumed_sessions += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, dict(self.headers)))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self._send_empty(404)
+            return
+        etag = self.server.etags.get(self.path)
+        if etag and self.headers.get("If-None-Match") == etag:
+            self._send_empty(304, ETag=etag)
+            return
+
+        status, headers = 200, {}
+        if etag:
+            headers["ETag"] = etag
+        offset = self._range_offset(etag)
+        if offset:
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (
+                offset,
+                len(body) - 1,
+                len(body),
+            )
+            body = body[offset:]
+        encoding, encode = self.server.encoding or (None, None)
+        if encoding and encoding in self.headers.get("Accept-Encoding", ""):
+            body = encode(body)
+            headers["Content-Encoding"] = encoding
+
+        self.send_response(status)
+        headers["Content-Length"] = str(len(body))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.server.truncate is not None:
+            # the connection breaks in the middle of the response
+            self.wfile.write(body[: self.server.truncate])
+            self.server.truncate = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+        self._finish_response()
+
+    def _range_offset(self, etag):
+        """Start of the requested range, 0 for the whole body"""
+        range_ = self.headers.get("Range", "")
+        if_range = self.headers.get("If-Range")
+        if not range_.startswith("bytes=") or (if_range and if_range != etag):
+            return 0
+        return int(range_[len("bytes=") :].rstrip("-"))
+
+    def _send_empty(self, status, **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("POST", self.path, dict(self.headers)))
+        self.server.posts.append(body)
+        if self.server.drop_posts:
+            # received, but the response never makes it to the client
+            self.close_connection = True
+            return
+        self._send_empty(201)
+        self._finish_response()
+
+    def _finish_response(self):
+        if self.server.close_idle:
+            # keep-alive as far as the client knows
+            self.close_connection = True
+
+
+class HTTPSServer(http.server.ThreadingHTTPServer):
+    """Server doing the TLS handshake of the connections it accepts"""
+
+    def __init__(self, address, handler, ssl_context):
+        super().__init__(address, handler)
+        self.ssl_context = ssl_context
+
+    def get_request(self):
+        sock, address = super().get_request()
+        return self.ssl_context.wrap_socket(sock, server_side=True), address
+
+
+def serve(server, scheme):
+    server.files = {}
+    server.etags = {}
+    # name and function of the content encoding of the responses
+    server.encoding = None
+    server.truncate = None
+    server.requests = []
+    server.posts = []
+    server.connections = 0
+    server.resumed_sessions = 0
+    server.drop_posts = False
+    server.close_idle = False
+    server.url = "%s://127.0.0.1:%d" % (scheme, server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def server():
+    yield from serve(http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler), "http")
+
+
+@pytest.fixture(scope="session")
+def certificate(tmp_path_factory):
+    """Self-signed certificate and key files for 127.0.0.1"""
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is not available")
+    directory = tmp_path_factory.mktemp("certificate")
+    cert, key = str(directory / "cert.pem"), str(directory / "key.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+@pytest.fixture
+def https_server(certificate):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    yield from serve(HTTPSServer(("127.0.0.1", 0), Handler, context), "https")
+
+
+@pytest.fixture(autouse=True)
+def state_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "http_promise_state.json")
+    monkeypatch.setattr(http_promise_type, "STATE_FILE", path)
+    for name in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+    return path
+
+
+@pytest.fixture
+def module():
+    module = HTTPPromiseModule()
+    module._out = io.StringIO()
+    module._log_level = "info"
+    yield module
+    module.protocol_terminate()
+
+
+def evaluate(module, url, **attributes):
+    return module.evaluate_promise(url, attributes, {})[0]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_downloads_from_one_host_use_one_connection(module, server, tmp_path):
+    for i in range(100):
+        server.files["/file%d" % i] = b"content %d\n" % i
+    for i in range(100):
+        target = str(tmp_path / ("file%d" % i))
+        assert evaluate(module, server.url + "/file%d" % i, file=target) == (
+            Result.REPAIRED
+        )
+    assert server.connections == 1
+    assert len(server.requests) == 100
+
+
+def test_https_downloads_use_one_connection(module, https_server, tmp_path):
+    for i in range(100):
+        https_server.files["/file%d" % i] = b"content %d\n" % i
+    for i in range(100):
+        target = str(tmp_path / ("file%d" % i))
+        result = evaluate(
+            module, https_server.url + "/file%d" % i, file=target, insecure="true"
+        )
+        assert result == Result.REPAIRED
+        assert read(target) == b"content %d\n" % i
+    # one full handshake for all the downloads
+    assert https_server.connections == 1
+    assert https_server.resumed_sessions == 0
+
+
+def test_https_reconnections_resume_tls_session(module, https_server, tmp_path):
+    https_server.close_idle = True
+    for i in range(5):
+        https_server.files["/file%d" % i] = b"content %d\n" % i
+    for i in range(5):
+        target = str(tmp_path / ("file%d" % i))
+        result = evaluate(
+            module, https_server.url + "/file%d" % i, file=target, insecure="true"
+        )
+        assert result == Result.REPAIRED
+    # a full handshake, then the session is resumed on every new connection
+    assert https_server.connections == 5
+    assert https_server.resumed_sessions == 4
+
+
+def test_https_certificate_verified_by_default(module, https_server, tmp_path):
+    https_server.files["/file"] = b"content\n"
+    target = str(tmp_path / "file")
+    assert evaluate(module, https_server.url + "/file", file=target) == (
+        Result.NOT_KEPT
+    )
+    assert not os.path.exists(target)
+
+
+def test_get_sent_again_when_idle_connection_closed(module, server, tmp_path):
+    server.files["/one"] = server.files["/two"] = b"content\n"
+    server.close_idle = True
+    assert evaluate(module, server.url + "/one", file=str(tmp_path / "one")) == (
+        Result.REPAIRED
+    )
+    assert evaluate(module, server.url + "/two", file=str(tmp_path / "two")) == (
+        Result.REPAIRED
+    )
+    assert server.connections == 2
+
+
+def test_post_on_closed_idle_connection_sent_once(module, server, tmp_path):
+    server.files["/one"] = b"content\n"
+    server.close_idle = True
+    evaluate(module, server.url + "/one", file=str(tmp_path / "one"))
+
+    result = evaluate(module, server.url + "/api", method="POST", payload="data")
+    assert result == Result.KEPT
+    assert server.posts == [b"data"]
+
+
+def test_post_not_sent_again_when_connection_breaks(module, server, tmp_path):
+    server.files["/one"] = b"content\n"
+    evaluate(module, server.url + "/one", file=str(tmp_path / "one"))
+
+    server.drop_posts = True
+    result = evaluate(module, server.url + "/api", method="POST", payload="data")
+    assert result == Result.NOT_KEPT
+    assert server.posts == [b"data"]
+
+
+def test_not_modified_is_kept_without_touching_the_file(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    server.etags["/file"] = '"v1"'
+    target = str(tmp_path / "file")
+    assert evaluate(module, server.url + "/file", file=target) == Result.REPAIRED
+    mtime_ns = os.stat(target).st_mtime_ns
+
+    assert evaluate(module, server.url + "/file", file=target) == Result.KEPT
+    assert server.requests[-1][2]["If-None-Match"] == '"v1"'
+    assert os.stat(target).st_mtime_ns == mtime_ns
+    assert read(target) == b"content\n"
+
+
+def test_changed_etag_downloads_again(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    server.etags["/file"] = '"v1"'
+    target = str(tmp_path / "file")
+    evaluate(module, server.url + "/file", file=target)
+
+    server.files["/file"] = b"new content\n"
+    server.etags["/file"] = '"v2"'
+    assert evaluate(module, server.url + "/file", file=target) == Result.REPAIRED
+    assert read(target) == b"new content\n"
+    assert "Range" not in server.requests[-1][2]
+
+
+def test_modified_file_requested_unconditionally(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    server.etags["/file"] = '"v1"'
+    target = str(tmp_path / "file")
+    evaluate(module, server.url + "/file", file=target)
+    with open(target, "ab") as f:
+        f.write(b"local change\n")
+
+    assert evaluate(module, server.url + "/file", file=target) == Result.REPAIRED
+    assert "If-None-Match" not in server.requests[-1][2]
+    assert read(target) == b"content\n"
+
+
+def test_checksum_mismatch_leaves_file_unchanged(module, server, tmp_path):
+    server.files["/file"] = b"tampered\n"
+    target = str(tmp_path / "file")
+    with open(target, "wb") as f:
+        f.write(b"old\n")
+
+    sha256 = hashlib.sha256(b"expected\n").hexdigest()
+    result, classes = module.evaluate_promise(
+        server.url + "/file", {"file": target, "sha256": sha256}, {}
+    )
+    assert result == Result.NOT_KEPT
+    assert any(c.endswith("_GET_checksum_failed") for c in classes)
+    assert read(target) == b"old\n"
+    assert not os.path.exists(target + ".cftemp")
+
+
+def test_matching_checksum_kept_without_request(module, server, tmp_path):
+    server.files["/file"] = b"expected\n"
+    target = str(tmp_path / "file")
+    url, sha256 = server.url + "/file", hashlib.sha256(b"expected\n").hexdigest()
+    assert evaluate(module, url, file=target, sha256=sha256) == Result.REPAIRED
+    requests = len(server.requests)
+
+    assert evaluate(module, url, file=target, sha256=sha256) == Result.KEPT
+    assert len(server.requests) == requests
+
+
+def test_interrupted_download_resumed(module, server, tmp_path):
+    body = bytes(range(256)) * 64
+    server.files["/file"] = body
+    server.etags["/file"] = '"v1"'
+    server.truncate = 1000
+    target = str(tmp_path / "file")
+    assert evaluate(module, server.url + "/file", file=target) == Result.NOT_KEPT
+    assert os.path.getsize(target + ".cftemp") == 1000
+
+    assert evaluate(module, server.url + "/file", file=target) == Result.REPAIRED
+    headers = server.requests[-1][2]
+    assert headers["Range"] == "bytes=1000-"
+    assert headers["If-Range"] == '"v1"'
+    assert read(target) == body
+
+
+def test_interrupted_download_of_changed_file_restarted(module, server, tmp_path):
+    server.files["/file"] = b"a" * 4096
+    server.etags["/file"] = '"v1"'
+    server.truncate = 1000
+    target = str(tmp_path / "file")
+    evaluate(module, server.url + "/file", file=target)
+
+    server.files["/file"] = b"b" * 4096
+    server.etags["/file"] = '"v2"'
+    assert evaluate(module, server.url + "/file", file=target) == Result.REPAIRED
+    assert read(target) == b"b" * 4096
+
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+ENCODINGS = [
+    ("gzip", gzip.compress),
+    ("deflate", zlib.compress),
+    # raw deflate data, sent by some servers instead of a zlib stream
+    ("deflate", raw_deflate),
+]
+
+
+@pytest.mark.parametrize("encoding,encode", ENCODINGS)
+def test_compressed_response_decoded(module, server, tmp_path, encoding, encode):
+    body = b"compressible content\n" * 1000
+    server.files["/file"] = body
+    server.encoding = (encoding, encode)
+    target = str(tmp_path / "file")
+    sha256 = hashlib.sha256(body).hexdigest()
+    result = evaluate(
+        module, server.url + "/file", file=target, compression="true", sha256=sha256
+    )
+    assert result == Result.REPAIRED
+    assert encoding in server.requests[-1][2]["Accept-Encoding"]
+    assert read(target) == body
+
+
+@pytest.mark.parametrize("encoding,encode", ENCODINGS)
+def test_decompressor_byte_by_byte(encoding, encode):
+    body = b"compressible content\n" * 100
+    decompressor = http_promise_type._decompressor(encoding)
+    data = encode(body)
+    output = b"".join(
+        decompressor.decompress(data[i : i + 1]) for i in range(len(data))
+    )
+    assert output + decompressor.flush() == body
+
+
+def test_compression_not_requested_by_default(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    server.encoding = ("gzip", gzip.compress)
+    target = str(tmp_path / "file")
+    evaluate(module, server.url + "/file", file=target)
+    assert server.requests[-1][2].get("Accept-Encoding", "identity") == "identity"
+    assert read(target) == b"content\n"
+
+
+def cache_object(cache_dir, content):
+    digest = hashlib.sha256(content).hexdigest()
+    return os.path.join(cache_dir, "sha256", digest[:2], digest)
+
+
+def test_not_modified_copies_file_from_cache(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    server.etags["/file"] = '"v1"'
+    cache_dir = str(tmp_path / "cache")
+    url, one, two = server.url + "/file", str(tmp_path / "one"), str(tmp_path / "two")
+    evaluate(module, url, file=one, cache_dir=cache_dir)
+
+    assert evaluate(module, url, file=two, cache_dir=cache_dir) == Result.REPAIRED
+    assert server.requests[-1][2]["If-None-Match"] == '"v1"'
+    assert read(two) == b"content\n"
+    # neither file shares its inode with the cached one
+    inode = os.stat(cache_object(cache_dir, b"content\n")).st_ino
+    assert inode not in (os.stat(one).st_ino, os.stat(two).st_ino)
+
+
+def test_cache_hardlinks(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    server.etags["/file"] = '"v1"'
+    cache_dir = str(tmp_path / "cache")
+    url, one, two = server.url + "/file", str(tmp_path / "one"), str(tmp_path / "two")
+    for target in (one, two):
+        evaluate(module, url, file=target, cache_dir=cache_dir, cache_hardlinks="true")
+    inode = os.stat(cache_object(cache_dir, b"content\n")).st_ino
+    assert os.stat(one).st_ino == os.stat(two).st_ino == inode
+
+
+def test_corrupted_cached_file_not_used(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    server.etags["/file"] = '"v1"'
+    cache_dir = str(tmp_path / "cache")
+    url, one, two = server.url + "/file", str(tmp_path / "one"), str(tmp_path / "two")
+    evaluate(module, url, file=one, cache_dir=cache_dir)
+    with open(cache_object(cache_dir, b"content\n"), "wb") as f:
+        f.write(b"corrupted\n")
+
+    assert evaluate(module, url, file=two, cache_dir=cache_dir) == Result.REPAIRED
+    assert "If-None-Match" not in server.requests[-1][2]
+    assert read(two) == b"content\n"
+    # cached again from the new download
+    assert read(cache_object(cache_dir, b"content\n")) == b"content\n"
+
+
+def test_checksum_copies_file_from_cache_without_request(module, server, tmp_path):
+    server.files["/file"] = b"content\n"
+    cache_dir = str(tmp_path / "cache")
+    url, one, two = server.url + "/file", str(tmp_path / "one"), str(tmp_path / "two")
+    sha256 = hashlib.sha256(b"content\n").hexdigest()
+    evaluate(module, url, file=one, cache_dir=cache_dir, sha256=sha256)
+    requests = len(server.requests)
+
+    result = evaluate(module, url, file=two, cache_dir=cache_dir, sha256=sha256)
+    assert result == Result.REPAIRED
+    assert len(server.requests) == requests
+    assert read(two) == b"content\n"
+    # known to have the checksum from now on
+    result = evaluate(module, url, file=two, cache_dir=cache_dir, sha256=sha256)
+    assert result == Result.KEPT
@@ -1,12 +1,108 @@
 import os
+import re
 import subprocess
 
 from enum import Enum
 from typing import Dict, List, Optional, Tuple
 
-from cfengine_module_library import PromiseModule, Result, AttributeObject
+from cfengine_module_library import (
+    PromiseModule,
+    ValidationError,
+    Result,
+    AttributeObject,
+)
 
 SYSTEMD_LIB_PATH = "/lib/systemd/system"
+SYSTEMD_ETC_PATH = "/etc/systemd/system"
+
+# Resource-control and process-limit settings of the [Service] section, as
+# (attribute, systemd key) pairs. They are rendered into full unit files and
+# drop-ins alike.
+SERVICE_RESOURCE_SETTINGS = (
+    ("service_cpu_affinity", "CPUAffinity"),
+    ("service_cpu_quota", "CPUQuota"),
+    ("service_cpu_weight", "CPUWeight"),
+    ("service_io_weight", "IOWeight"),
+    ("service_memory_high", "MemoryHigh"),
+    ("service_memory_max", "MemoryMax"),
+    ("service_tasks_max", "TasksMax"),
+    ("service_limit_nofile", "LimitNOFILE"),
+)
+
+
+# Settings which systemctl set-property can change on a running unit, as
+# (systemd key, property reported by systemctl show) pairs
+LIVE_RESOURCE_PROPERTIES = (
+    ("CPUQuota", "CPUQuotaPerSecUSec"),
+    ("CPUWeight", "CPUWeight"),
+    ("IOWeight", "IOWeight"),
+    ("MemoryHigh", "MemoryHigh"),
+    ("MemoryMax", "MemoryMax"),
+    ("TasksMax", "TasksMax"),
+)
+
+# systemctl show reports "no limit" either as "infinity" or as UINT64_MAX
+_INFINITY = 2**64 - 1
+_SIZE_SUFFIXES = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40, "P": 2**50}
+_TIMESPAN_UNITS = {"us": 1, "ms": 10**3, "s": 10**6, "min": 60 * 10**6}
+# systemd stores CPUQuota in whole percents, i.e. steps of 10ms per second
+_CPU_QUOTA_STEP = 10**4
+
+
+def _physical_memory() -> int:
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def _system_tasks_max() -> int:
+    with open("/proc/sys/kernel/pid_max") as f:
+        pid_max = int(f.read())
+    with open("/proc/sys/kernel/threads-max") as f:
+        threads_max = int(f.read())
+    return min(pid_max - 1, threads_max)
+
+
+def _resource_value(key: str, value: str) -> Optional[int]:
+    """Convert a resource-control value, as written in a unit file or as reported
+    by systemctl show, to a number which can be compared. Returns None if the
+    value can't be interpreted."""
+    value = value.strip()
+    if value in ("", "infinity"):
+        return _INFINITY
+    try:
+        if value.endswith("%"):
+            permyriad = round(float(value[:-1]) * 100)
+            if key == "CPUQuota":
+                # CPUQuota=100% is one second of CPU time per second
+                usec = permyriad * 100
+                return usec - usec % _CPU_QUOTA_STEP
+            if key in ("MemoryHigh", "MemoryMax"):
+                return _physical_memory() * permyriad // 10000
+            if key == "TasksMax":
+                return _system_tasks_max() * permyriad // 10000
+            return None
+        if key == "CPUQuota":
+            spans = re.findall(r"(\d+(?:\.\d+)?)\s*(us|ms|s|min)", value)
+            if not spans:
+                return None
+            usec = round(sum(float(n) * _TIMESPAN_UNITS[unit] for n, unit in spans))
+            return usec - usec % _CPU_QUOTA_STEP
+        if key in ("MemoryHigh", "MemoryMax"):
+            match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGTP]?)", value)
+            if not match:
+                return None
+            number = match.group(1)
+            if "." in number:
+                return int(float(number) * _SIZE_SUFFIXES[match.group(2)])
+            # not through float, which can't hold UINT64_MAX ("no limit")
+            return int(number) * _SIZE_SUFFIXES[match.group(2)]
+        return int(value)
+    except (OSError, ValueError):
+        return None
+
+
+def _file_content(path: str) -> str:
+    with open(path) as f:
+        return f.read()
 
 
 class SystemdPromiseTypeStates(Enum):
@@ -34,9 +130,15 @@ class SystemdPromiseTypeModule(PromiseModule):
                 raise ValueError("invalid value")
             return v
 
+        def drop_in_must_be_a_file_name(v):
+            if not v or "/" in v or v in (".", ".."):
+                raise ValidationError("must be a file name, not '{v}'".format(v=v))
+
         self.add_attribute("daemon_reexec", bool, default=False)
         self.add_attribute("daemon_reload", bool, default=False)
+        self.add_attribute("drop_in", str, validator=drop_in_must_be_a_file_name)
         self.add_attribute("enabled", bool, default=True)
+        self.add_attribute("live_resource_control", bool, default=False)
         self.add_attribute("masked", bool, default=False)
         self.add_attribute("name", str, required=True, default_to_promiser=True)
         self.add_attribute("replace", bool, default=True)
@@ -69,6 +171,14 @@ class SystemdPromiseTypeModule(PromiseModule):
         self.add_attribute("service_standard_output", str)
         self.add_attribute("service_standard_error", str)
         self.add_attribute("service_tty_path", str)
+        self.add_attribute("service_cpu_affinity", str)
+        self.add_attribute("service_cpu_quota", str)
+        self.add_attribute("service_cpu_weight", int)
+        self.add_attribute("service_io_weight", int)
+        self.add_attribute("service_memory_high", str)
+        self.add_attribute("service_memory_max", str)
+        self.add_attribute("service_tasks_max", str)
+        self.add_attribute("service_limit_nofile", str)
         self.add_attribute("service_extra", list, default=[])
         self.add_attribute("install_wanted_by", list, default=[])
         self.add_attribute("install_required_by", list, default=[])
@@ -96,6 +206,7 @@ class SystemdPromiseTypeModule(PromiseModule):
                     "-p",
                     "UnitFileState",
                 ]
+                + [arg for _, prop in LIVE_RESOURCE_PROPERTIES for arg in ("-p", prop)]
             )
             service_status = dict(k.split("=", 1) for k in output.strip().splitlines())
         except subprocess.CalledProcessError as e:
@@ -109,7 +220,9 @@ class SystemdPromiseTypeModule(PromiseModule):
                 ["{safe_promiser}_show_failed".format(safe_promiser=promiser)],
             )
         # apply the changes
-        if model.state == SystemdPromiseTypeStates.ABSENT.value:
+        if model.state == SystemdPromiseTypeStates.ABSENT.value and model.drop_in:
+            return self._drop_in_absent(model, promiser)
+        elif model.state == SystemdPromiseTypeStates.ABSENT.value:
             return self._service_absent(model, promiser, service_status)
         else:
             return self._service_present(model, promiser, service_status)
@@ -205,29 +318,80 @@ class SystemdPromiseTypeModule(PromiseModule):
             classes.append("{safe_promiser}_absent".format(safe_promiser=safe_promiser))
         return (result, classes)
 
+    def _drop_in_absent(
+        self, model: AttributeObject, safe_promiser: str
+    ) -> Tuple[str, List[str]]:
+        # only the drop-in is removed, the unit it overrides is left alone
+        path = self._drop_in_path(model)
+        if not os.path.exists(path):
+            return (Result.KEPT, [])
+        try:
+            os.unlink(path)
+            if not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+        except OSError as e:
+            self.log_error("Failed to remove the drop-in file: {error}".format(error=e))
+            return (
+                Result.NOT_KEPT,
+                ["{safe_promiser}_remove_failed".format(safe_promiser=safe_promiser)],
+            )
+        self.log_info("Removed the drop-in {path}".format(path=path))
+        try:
+            self._exec_command(["systemctl", "daemon-reload"])
+        except subprocess.CalledProcessError as e:
+            self.log_error(
+                "Failed to run systemctl: {error}".format(error=e.output or e)
+            )
+            if e.stderr:
+                self.log_error(e.stderr.strip())
+            return (
+                Result.NOT_KEPT,
+                [
+                    "{safe_promiser}_daemon_reload_failed".format(
+                        safe_promiser=safe_promiser
+                    )
+                ],
+            )
+        self.log_info("Reloaded the list of services")
+        return (
+            Result.REPAIRED,
+            ["{safe_promiser}_absent".format(safe_promiser=safe_promiser)],
+        )
+
     def _service_present(
         self, model: AttributeObject, safe_promiser: str, service_status: dict
     ) -> Tuple[str, List[str]]:
         classes = []
         result = Result.KEPT
-        # render the template of the service
-        service_template = self._render_service_template(model)
-        # create the service file if it doesn't exist, or replace it if the content
+        # render the template of the service, or of the drop-in overriding it
+        if model.drop_in:
+            service_path = self._drop_in_path(model)
+            service_template = self._render_service_template(model, drop_in=True)
+        else:
+            service_path = os.path.join(
+                SYSTEMD_LIB_PATH, "{model_name}.service".format(model_name=model.name)
+            )
+            service_template = self._render_service_template(model)
+        # create the file if it doesn't exist, or replace it if the content
         # doesn't match our template and replace is true
-        service_path = os.path.join(
-            SYSTEMD_LIB_PATH, "{model_name}.service".format(model_name=model.name)
-        )
         try:
-            if (
-                not os.path.exists(service_path)
-                or model.replace
-                and open(service_path).read() != service_template
+            if not os.path.exists(service_path) or (
+                model.replace and _file_content(service_path) != service_template
             ):
-                open(service_path, "w").write(service_template)
+                os.makedirs(os.path.dirname(service_path), exist_ok=True)
+                with open(service_path, "w") as f:
+                    f.write(service_template)
                 result = Result.REPAIRED
-                self.log_info(
-                    "Installed the service {model_name}".format(model_name=model.name)
-                )
+                if model.drop_in:
+                    self.log_info(
+                        "Installed the drop-in {path}".format(path=service_path)
+                    )
+                else:
+                    self.log_info(
+                        "Installed the service {model_name}".format(
+                            model_name=model.name
+                        )
+                    )
                 classes.append(
                     "{safe_promiser}_installed".format(safe_promiser=safe_promiser)
                 )
@@ -381,6 +545,40 @@ class SystemdPromiseTypeModule(PromiseModule):
             classes.append(
                 "{safe_promiser}_disabled".format(safe_promiser=safe_promiser)
             )
+        # apply changed resource-control settings to the running service
+        if model.live_resource_control and service_status["ActiveState"] == "active":
+            properties = self._live_resource_changes(model, service_status)
+            if properties:
+                try:
+                    self._exec_command(
+                        ["systemctl", "set-property", "--runtime", model.name]
+                        + properties
+                    )
+                except subprocess.CalledProcessError as e:
+                    self.log_error(
+                        "Failed to run systemctl: {error}".format(error=e.output or e)
+                    )
+                    if e.stderr:
+                        self.log_error(e.stderr.strip())
+                    return (
+                        Result.NOT_KEPT,
+                        [
+                            "{safe_promiser}_set_property_failed".format(
+                                safe_promiser=safe_promiser
+                            )
+                        ],
+                    )
+                result = Result.REPAIRED
+                self.log_info(
+                    "Applied {properties} to the running service {model_name}".format(
+                        properties=" ".join(properties), model_name=model.name
+                    )
+                )
+                classes.append(
+                    "{safe_promiser}_resources_applied".format(
+                        safe_promiser=safe_promiser
+                    )
+                )
         # start the service, if not running
         if model.state == SystemdPromiseTypeStates.STARTED.value and not (
             service_status["ActiveState"] == "active"
@@ -493,7 +691,45 @@ class SystemdPromiseTypeModule(PromiseModule):
             self.log_verbose(output)
         return output
 
-    def _render_service_template(self, model: AttributeObject) -> str:
+    def _live_resource_changes(
+        self, model: AttributeObject, service_status: dict
+    ) -> List[str]:
+        promised = {
+            key: str(getattr(model, attr))
+            for attr, key in SERVICE_RESOURCE_SETTINGS
+            if getattr(model, attr) is not None
+        }
+        changes = []
+        for key, prop in LIVE_RESOURCE_PROPERTIES:
+            if key not in promised:
+                continue
+            wanted = _resource_value(key, promised[key])
+            current = _resource_value(key, service_status.get(prop, ""))
+            if wanted is None or wanted != current:
+                self.log_verbose(
+                    "{key} of {model_name} is '{current}', promised '{wanted}'".format(
+                        key=key,
+                        model_name=model.name,
+                        current=service_status.get(prop, ""),
+                        wanted=promised[key],
+                    )
+                )
+                changes.append("{key}={value}".format(key=key, value=promised[key]))
+        return changes
+
+    def _drop_in_path(self, model: AttributeObject) -> str:
+        file_name = model.drop_in
+        if not file_name.endswith(".conf"):
+            file_name += ".conf"
+        return os.path.join(
+            SYSTEMD_ETC_PATH,
+            "{model_name}.service.d".format(model_name=model.name),
+            file_name,
+        )
+
+    def _render_service_template(
+        self, model: AttributeObject, drop_in: bool = False
+    ) -> str:
         blocks = {
             "unit": [],
             "service": [],
@@ -525,6 +761,7 @@ class SystemdPromiseTypeModule(PromiseModule):
             ("service", "service_standard_output", "StandardOutput"),
             ("service", "service_standard_error", "StandardError"),
             ("service", "service_tty_path", "TTYPath"),
+            *(("service", attr, key) for attr, key in SERVICE_RESOURCE_SETTINGS),
             ("install", "install_wanted_by", "WantedBy"),
             ("install", "install_required_by", "RequiredBy"),
         ):
@@ -549,6 +786,17 @@ class SystemdPromiseTypeModule(PromiseModule):
             blocks["unit"].extend(model.install_extra)
         install_section = "\n".join(blocks["install"])
         #
+        if drop_in:
+            # a drop-in only carries the sections it overrides
+            return "# Rendered by CFEngine. Do not edit directly\n" + "".join(
+                "\n[{name}]\n{section}\n".format(name=name, section=section)
+                for name, section in (
+                    ("Unit", unit_section),
+                    ("Service", service_section),
+                    ("Install", install_section),
+                )
+                if section
+            )
         return (
             "# Rendered by CFEngine. Do not edit directly\n\n"
             + "[Unit]\n{unit_section}\n\n".format(unit_section=unit_section)
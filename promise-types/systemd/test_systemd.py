@@ -0,0 +1,238 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../libraries/python"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from cfengine_module_library import Result  # noqa: E402
+
+import systemd as systemd_module  # noqa: E402
+from systemd import SystemdPromiseTypeModule  # noqa: E402
+
+
+class Systemctl:
+    """Stand-in for systemctl, answering show with the status and recording
+    the other commands."""
+
+    def __init__(self):
+        self.status = {
+            "ActiveState": "active",
+            "SubState": "running",
+            "UnitFileState": "enabled",
+        }
+        self.commands = []
+
+    def __call__(self, args, cwd=None):
+        if args[1] == "show":
+            return "\n".join(
+                "{key}={value}".format(key=key, value=value)
+                for key, value in self.status.items()
+            )
+        self.commands.append(" ".join(args[1:]))
+        return ""
+
+
+@pytest.fixture(autouse=True)
+def unit_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(systemd_module, "SYSTEMD_LIB_PATH", str(tmp_path / "lib"))
+    monkeypatch.setattr(systemd_module, "SYSTEMD_ETC_PATH", str(tmp_path / "etc"))
+    return tmp_path
+
+
+@pytest.fixture
+def module():
+    module = SystemdPromiseTypeModule()
+    module._out = io.StringIO()
+    module._log_level = "info"
+    return module
+
+
+@pytest.fixture
+def systemctl(module, monkeypatch):
+    systemctl = Systemctl()
+    monkeypatch.setattr(module, "_exec_command", systemctl)
+    return systemctl
+
+
+DROP_IN = {
+    "name": "nginx",
+    "drop_in": "50-resources",
+    "state": "started",
+    "service_cpu_quota": "200%",
+    "service_memory_max": "2G",
+}
+
+
+def test_drop_in_only_renders_overridden_sections(module):
+    model = module.create_attribute_object("nginx", DROP_IN)
+    assert module._render_service_template(model, drop_in=True) == (
+        "# Rendered by CFEngine. Do not edit directly\n"
+        "\n[Service]\nCPUQuota=200%\nMemoryMax=2G\n"
+    )
+
+
+def test_drop_in_path_appends_conf(module):
+    model = module.create_attribute_object("nginx", DROP_IN)
+    assert module._drop_in_path(model) == os.path.join(
+        systemd_module.SYSTEMD_ETC_PATH, "nginx.service.d", "50-resources.conf"
+    )
+
+
+def test_drop_in_installed_and_reloaded(module, systemctl):
+    result, classes = module.evaluate_promise("nginx", DROP_IN, {})
+    assert result == Result.REPAIRED
+    assert "nginx_installed" in classes
+    assert systemctl.commands == ["daemon-reload"]
+
+    path = os.path.join(
+        systemd_module.SYSTEMD_ETC_PATH, "nginx.service.d", "50-resources.conf"
+    )
+    with open(path) as f:
+        assert "CPUQuota=200%" in f.read()
+    # the unit file itself isn't managed
+    assert not os.path.exists(systemd_module.SYSTEMD_LIB_PATH)
+
+
+def test_unchanged_drop_in_is_kept_without_reload(module, systemctl):
+    module.evaluate_promise("nginx", DROP_IN, {})
+    systemctl.commands.clear()
+
+    result, classes = module.evaluate_promise("nginx", DROP_IN, {})
+    assert result == Result.KEPT
+    assert classes == []
+    assert systemctl.commands == []
+
+
+def test_changed_drop_in_is_replaced_and_reloaded(module, systemctl):
+    module.evaluate_promise("nginx", DROP_IN, {})
+    systemctl.commands.clear()
+
+    result, _ = module.evaluate_promise(
+        "nginx", dict(DROP_IN, service_memory_max="1G"), {}
+    )
+    assert result == Result.REPAIRED
+    assert systemctl.commands == ["daemon-reload"]
+
+
+def test_daemon_reload_attribute_forces_reload(module, systemctl):
+    module.evaluate_promise("nginx", DROP_IN, {})
+    systemctl.commands.clear()
+
+    module.evaluate_promise("nginx", dict(DROP_IN, daemon_reload=True), {})
+    assert systemctl.commands == ["daemon-reload"]
+
+
+def test_modified_file_not_replaced_without_replace(module, systemctl):
+    module.evaluate_promise("nginx", DROP_IN, {})
+    path = module._drop_in_path(module.create_attribute_object("nginx", DROP_IN))
+    with open(path, "w") as f:
+        f.write("[Service]\nCPUQuota=10%\n")
+    systemctl.commands.clear()
+
+    result, _ = module.evaluate_promise("nginx", dict(DROP_IN, replace=False), {})
+    assert result == Result.KEPT
+    assert systemctl.commands == []
+    with open(path) as f:
+        assert f.read() == "[Service]\nCPUQuota=10%\n"
+
+
+def test_drop_in_absent_removes_file_and_directory(module, systemctl):
+    module.evaluate_promise("nginx", DROP_IN, {})
+    path = module._drop_in_path(module.create_attribute_object("nginx", DROP_IN))
+    systemctl.commands.clear()
+
+    result, classes = module.evaluate_promise(
+        "nginx", dict(DROP_IN, state="absent"), {}
+    )
+    assert result == Result.REPAIRED
+    assert classes == ["nginx_absent"]
+    assert systemctl.commands == ["daemon-reload"]
+    assert not os.path.exists(os.path.dirname(path))
+
+
+def test_drop_in_absent_keeps_other_drop_ins(module, systemctl):
+    module.evaluate_promise("nginx", DROP_IN, {})
+    path = module._drop_in_path(module.create_attribute_object("nginx", DROP_IN))
+    other = os.path.join(os.path.dirname(path), "10-other.conf")
+    with open(other, "w") as f:
+        f.write("[Service]\nNice=5\n")
+
+    module.evaluate_promise("nginx", dict(DROP_IN, state="absent"), {})
+    assert not os.path.exists(path)
+    assert os.path.exists(other)
+
+
+def test_missing_drop_in_absent_is_kept(module, systemctl):
+    result, classes = module.evaluate_promise(
+        "nginx", dict(DROP_IN, state="absent"), {}
+    )
+    assert (result, classes) == (Result.KEPT, [])
+    assert systemctl.commands == []
+
+
+@pytest.mark.parametrize(
+    "key,value,expected",
+    [
+        ("CPUQuota", "50%", 500000),
+        ("CPUQuota", "200%", 2000000),
+        ("CPUQuota", "500ms", 500000),
+        ("CPUQuota", "1s 500ms", 1500000),
+        # systemd only keeps whole percents
+        ("CPUQuota", "33.33%", 330000),
+        ("CPUQuota", "333.3ms", 330000),
+        ("CPUQuota", "infinity", systemd_module._INFINITY),
+        ("CPUQuota", "", systemd_module._INFINITY),
+        ("CPUQuota", "fast", None),
+        ("CPUWeight", "100", 100),
+        ("MemoryMax", "2G", 2 * 2**30),
+        ("MemoryMax", "1.5M", int(1.5 * 2**20)),
+        ("MemoryMax", "2147483648", 2 * 2**30),
+        ("MemoryHigh", str(2**64 - 1), systemd_module._INFINITY),
+        ("MemoryMax", "lots", None),
+        ("TasksMax", "4096", 4096),
+        ("IOWeight", "5%", None),
+    ],
+)
+def test_resource_value(key, value, expected):
+    assert systemd_module._resource_value(key, value) == expected
+
+
+def test_resource_value_percent_of_memory(monkeypatch):
+    monkeypatch.setattr(systemd_module, "_physical_memory", lambda: 8 * 2**30)
+    assert systemd_module._resource_value("MemoryMax", "25%") == 2 * 2**30
+
+
+LIVE = dict(DROP_IN, live_resource_control=True)
+
+
+def test_live_resource_changes_detected(module):
+    model = module.create_attribute_object("nginx", LIVE)
+    status = {"CPUQuotaPerSecUSec": "1s", "MemoryMax": str(2 * 2**30)}
+    assert module._live_resource_changes(model, status) == ["CPUQuota=200%"]
+
+
+def test_live_resources_matching_systemd_rounding_unchanged(module):
+    model = module.create_attribute_object(
+        "nginx", dict(LIVE, service_cpu_quota="33.33%")
+    )
+    status = {"CPUQuotaPerSecUSec": "330ms", "MemoryMax": str(2 * 2**30)}
+    assert module._live_resource_changes(model, status) == []
+
+
+def test_live_resource_control_applied_once(module, systemctl):
+    module.evaluate_promise("nginx", LIVE, {})
+    systemctl.commands.clear()
+
+    systemctl.status.update(CPUQuotaPerSecUSec="1s", MemoryMax=str(2 * 2**30))
+    result, classes = module.evaluate_promise("nginx", LIVE, {})
+    assert result == Result.REPAIRED
+    assert "nginx_resources_applied" in classes
+    assert systemctl.commands == ["set-property --runtime nginx CPUQuota=200%"]
+
+    systemctl.commands.clear()
+    systemctl.status.update(CPUQuotaPerSecUSec="2s")
+    assert module.evaluate_promise("nginx", LIVE, {}) == (Result.KEPT, [])
+    assert systemctl.commands == []